@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of extracted ALOS-2 metadata, so reprocessing, retried jobs and
+settings.json version bumps do not rerun the expensive metadata extraction of a scene.
+
+Entries are json files in a local or shared directory, keyed on the dataset name and the
+name, size and mtime of the scene's IMG/LED files (extraction takes the mtimes from the zip).
+Hits refresh an entry's mtime and the least recently used entries are evicted once the cache
+grows past its size limit.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import logging
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'alos2-ingest', 'md')
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# bump when the layout of the cached metadata changes
+CACHE_VERSION = 1
+
+FINGERPRINT_PATTERNS = ('IMG*', 'LED*', 'summary.txt')
+
+
+def fingerprint(raw_dir, dataset_name):
+    """Cache key of a scene: its dataset name and the name, size and mtime of its image and leader files"""
+    h = hashlib.sha1("{}:{}".format(CACHE_VERSION, dataset_name).encode('utf-8'))
+    files = sorted(set(f for pattern in FINGERPRINT_PATTERNS
+                       for f in glob.glob(os.path.join(raw_dir, pattern))))
+    for f in files:
+        st = os.stat(f)
+        h.update("\n{}:{}:{}".format(os.path.basename(f), st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+class MetadataCache(object):
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir if cache_dir is not None else os.environ.get('ALOS2_MD_CACHE_DIR', DEFAULT_CACHE_DIR)
+        self.max_size = max_size if max_size is not None else int(os.environ.get('ALOS2_MD_CACHE_SIZE', DEFAULT_MAX_SIZE))
+
+    @property
+    def enabled(self):
+        # ALOS2_MD_CACHE_DIR="" turns the cache off
+        return bool(self.cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        logging.info("Metadata cache hit for %s" % key)
+        return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write aside and rename, readers on a shared filesystem never see a partial entry
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+            self.evict()
+        except OSError as e:
+            logging.warning("Unable to cache metadata in %s: %s" % (path, e))
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within max_size"""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.json')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
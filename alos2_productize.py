@@ -8,14 +8,18 @@ Ingest ALOS2 data from a source to a destination:
 
 """
 
-import os, re, requests, json, logging, traceback, argparse, shutil, glob
+import os, re, requests, json, logging, traceback, argparse, shutil, glob, math
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from requests.packages.urllib3.exceptions import InsecurePlatformWarning
 # import boto
+import concurrent.futures
+import multiprocessing
 import numpy as np
 import scipy.spatial
 from osgeo import gdal, osr
 import alos2_utils
+import scene_index
+import ingest_alos2_md
 from subprocess import check_call
 
 # disable warnings for SSL verification
@@ -30,122 +34,273 @@ logging.basicConfig(format=log_format, level=logging.INFO)
 # scale range
 SCALE_RANGE=[0, 7500]
 
-def gdal_translate(outfile, infile, options_string):
-    cmd = "gdal_translate {} {} {}".format(options_string, infile, outfile)
-    logging.info("cmd: %s" % cmd)
-    return check_call(cmd,  shell=True)
-
-def checkProjectionWGS84(file):
-    # check if file is suited for KML (needs to be projected in WGS 84 / EPSG 4326
-    ds = gdal.Open(file)
-    prj = ds.GetProjection()
-    srs = osr.SpatialReference(wkt=prj)
-    if "WGS 84" not in srs.GetAttrValue('geogcs'):
-        vrt_file = "{}.vrt".format(os.path.splitext(file)[0])
-        check_call("gdalwarp -of VRT -t_srs EPSG:4326 -overwrite {} {}".format(file, vrt_file), shell=True)
-        ret_file = vrt_file
-    else:
-        ret_file = file
-
-    return ret_file
-
-def writeMask(out_file, arr, basefile):
-    rows = arr.shape[0]
-    cols = arr.shape[1]
-    # create the raster file
-    base_ds = gdal.Open(basefile)
-    srs = osr.SpatialReference()  # establish encoding
-    srs.ImportFromWkt(base_ds.GetProjectionRef())  # WGS84 lat/long
-    if arr.ndim == 2:
-        if arr.dtype == np.bool:
-            # only 1 band, logical
-            dst_ds = gdal.GetDriverByName('GTiff').Create(out_file, cols, rows, 1, gdal.GDT_Byte, options = ["NBITS=1", "COMPRESS=PACKBITS"])
-            band1  = dst_ds.GetRasterBand(1)
-            band1.WriteArray(arr)  # write band to the raster
-
+# browse png size relative to the geotiff, and the thumbnail bounding box
+BROWSE_PCT = 10
+THUMBNAIL_SIZE = 250
+
+# footprint grid decimation, strip height in blocks, and simplification tolerance (degrees)
+FOOTPRINT_STEP = 10
+FOOTPRINT_STRIP_BLOCKS = 16
+FOOTPRINT_SIMPLIFY = 0.001
+
+# tiles are capped at this zoom, or the native resolution of the raster if lower
+TILE_MAX_ZOOM = 14
+TILE_PROCESSES = os.cpu_count() or 1
+
+# polarisations (HH/HV/VV/VH) processed concurrently
+POL_WORKERS = 4
+
+# scenes productized concurrently, overridden by $ALOS2_SCENE_WORKERS
+SCENE_WORKERS = 2
+# disk budget of the scenes in flight, from $ALOS2_DISK_BUDGET or the job-spec disk_usage, else this
+DISK_BUDGET = "200GB"
+
+def _simplify(points, tolerance):
+    """Douglas-Peucker simplification of an open Nx2 line."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        seg = points[end] - points[start]
+        rel = points[start + 1:end] - points[start]
+        seg_len = np.hypot(seg[0], seg[1])
+        if seg_len == 0:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
         else:
-            dst_ds = gdal.GetDriverByName('GTiff').Create(out_file, cols, rows, 1, gdal.GDT_Float32)
-            dst_ds.GetRasterBand(1).WriteArray(arr)
-            dst_ds.GetRasterBand(1).SetNoDataValue(0)
-
-        dst_ds.SetGeoTransform(base_ds.GetGeoTransform())  # specify coords
-        dst_ds.SetProjection(srs.ExportToWkt())  # export coords to file
-        dst_ds.FlushCache()  # write to disk
-
-
-def getFootprintJson(tif_file):
-    tif_file = checkProjectionWGS84(tif_file)
-    tmp_msk_file = os.path.join(os.path.dirname(os.path.abspath(tif_file)),"tmp_msk.tif")
-    tmp_msk_nodata_file = os.path.join(os.path.dirname(os.path.abspath(tif_file)),"tmp_msk_nodata.tif")
-    tmp_geojson = os.path.join(os.path.dirname(os.path.abspath(tif_file)),"tmp.json")
-    tmp_final_geojson = os.path.join(os.path.dirname(os.path.abspath(tif_file)),"tmp_final.json")
-
+            dist = np.abs(seg[0] * rel[:, 1] - seg[1] * rel[:, 0]) / seg_len
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            mid = start + 1 + idx
+            keep[mid] = True
+            stack.append((start, mid))
+            stack.append((mid, end))
+    return points[keep]
+
+
+def getFootprintJson(tif_file, step=FOOTPRINT_STEP):
+    """Footprint of the valid (non-zero) data in tif_file as a single polygon ring of
+       [lon, lat] pairs. The raster is read in strips on a grid decimated by step, and
+       the boundary is traced from the first/last valid column of each row, so holes
+       such as radar shadow in mountains do not split the footprint."""
     logging.info('Getting footprint of %s ...' % tif_file)
     ds = gdal.Open(tif_file)
-    file_arr = np.array(ds.GetRasterBand(1).ReadAsArray())  # assuming we only care about the base layer
-    footprint = file_arr != 0  # create radar footprint mask
-    writeMask(tmp_msk_file, footprint, tif_file)
-    logging.info("Creating polygon for file: %s" % tmp_msk_file)
-    check_call("gdal_translate -a_nodata 0 {} {}".format(tmp_msk_file, tmp_msk_nodata_file), shell=True)
-    check_call("gdal_polygonize.py -f GeoJSON {} {}".format(tmp_msk_nodata_file, tmp_geojson), shell=True)
-    check_call("ogr2ogr -f GeoJSON -simplify 0.001 {} {}".format(tmp_final_geojson, tmp_geojson), shell=True)
-
-    with open(tmp_final_geojson) as data_file:
-        data = json.load(data_file)
-
-    for tmpfile in glob.glob(os.path.join(os.path.dirname(os.path.abspath(tif_file)),'tmp*')):
-        os.remove(tmpfile)
+    band = ds.GetRasterBand(1)  # assuming we only care about the base layer
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    buf_xsize = max(1, xsize // step)
+    x_scale = float(xsize) / buf_xsize
+
+    left, right = [], []
+    strip_rows = max(step, band.GetBlockSize()[1] // step * step) * FOOTPRINT_STRIP_BLOCKS
+    for yoff in range(0, ysize, strip_rows):
+        rows = min(strip_rows, ysize - yoff)
+        buf_ysize = max(1, rows // step)
+        valid = band.ReadAsArray(0, yoff, xsize, rows, buf_xsize=buf_xsize, buf_ysize=buf_ysize) != 0
+        has_data = valid.any(axis=1)
+        first = valid.argmax(axis=1)
+        last = buf_xsize - 1 - valid[:, ::-1].argmax(axis=1)
+        y = yoff + (np.arange(buf_ysize) + 0.5) * float(rows) / buf_ysize
+        for i in np.nonzero(has_data)[0]:
+            left.append((first[i] * x_scale, y[i]))
+            right.append(((last[i] + 1) * x_scale, y[i]))
+
+    if not left:
+        raise RuntimeError("No valid data found in %s to create a footprint" % tif_file)
+
+    # walk down the left edge and back up the right edge
+    pixels = np.array(left + right[::-1])
+    gt = ds.GetGeoTransform()
+    xy = np.column_stack([gt[0] + pixels[:, 0] * gt[1] + pixels[:, 1] * gt[2],
+                          gt[3] + pixels[:, 0] * gt[4] + pixels[:, 1] * gt[5]])
+
+    src_srs = osr.SpatialReference(wkt=ds.GetProjection())
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if not src_srs.IsSame(dst_srs):
+        transform = osr.CoordinateTransformation(src_srs, dst_srs)
+        xy = np.array([pt[:2] for pt in transform.TransformPoints(xy.tolist())])
+
+    ring = _simplify(xy, FOOTPRINT_SIMPLIFY).tolist()
+    ring.append(ring[0])
+    return ring
+
+
+def _decimate_index(size, pct):
+    """Source indices gdal_translate -outsize pct% samples with nearest neighbour."""
+    out_size = max(1, int(size * pct / 100.0 + 0.5))
+    return ((np.arange(out_size) + 0.5) * size / out_size).astype(np.int64)
+
+
+def _thumbnail_size(xsize, ysize, box=THUMBNAIL_SIZE):
+    """Size that fits within box x box keeping the aspect ratio, like convert -resize."""
+    scale = min(float(box) / xsize, float(box) / ysize)
+    return max(1, int(round(xsize * scale))), max(1, int(round(ysize * scale)))
+
+
+def _write_thumbnail(out_file, ds):
+    width, height = _thumbnail_size(ds.RasterXSize, ds.RasterYSize)
+    gdal.Translate(out_file, ds, format='PNG', width=width, height=height, resampleAlg='average')
 
-    return data['features'][0]['geometry']['coordinates'][0]
 
 def process_geotiff_disp(infile):
-    """Reprocess JAXA's L1./ L2.1 geotiff to include nodata = 0 for display"""
+    """Reprocess JAXA's L1./ L2.1 geotiff to include nodata = 0 for display.
+       The source is read once in strips, and the same scaled strips also feed
+       the 10% browse png and its 250x250 thumbnail."""
     # removes nodata value from original geotiff file from jaxa
     outfile = os.path.splitext(infile)[0] + "_disp.tif"
     logging.info("Removing nodata and scaling intensity from %s to %s. Scale intensity at %s"
                  % (infile, outfile, SCALE_RANGE))
-    options_string = '-of GTiff -ot Byte -scale {} {} 0 255 -a_nodata 0'.format(SCALE_RANGE[0], SCALE_RANGE[1])
-    gdal_translate(outfile, infile, options_string)
+    src_ds = gdal.Open(infile)
+    src_band = src_ds.GetRasterBand(1)
+    xsize, ysize = src_ds.RasterXSize, src_ds.RasterYSize
+
+    dst_ds = gdal.GetDriverByName('GTiff').Create(outfile, xsize, ysize, 1, gdal.GDT_Byte)
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjection())
+    if src_ds.GetGCPCount():
+        dst_ds.SetGCPs(src_ds.GetGCPs(), src_ds.GetGCPProjection())
+    dst_ds.SetMetadata(src_ds.GetMetadata())
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue(0)
+
+    browse_rows = _decimate_index(ysize, BROWSE_PCT)
+    browse_cols = _decimate_index(xsize, BROWSE_PCT)
+    browse = np.zeros((len(browse_rows), len(browse_cols)), dtype=np.uint8)
+
+    # read whole blocks of rows, about 64MB of float32 at a time
+    block_rows = src_band.GetBlockSize()[1]
+    strip_rows = max(block_rows, (64 * 1024 * 1024 // (4 * xsize)) // block_rows * block_rows)
+    scale = 255.0 / (SCALE_RANGE[1] - SCALE_RANGE[0])
+    for yoff in range(0, ysize, strip_rows):
+        rows = min(strip_rows, ysize - yoff)
+        arr = src_band.ReadAsArray(0, yoff, xsize, rows).astype(np.float32)
+        scaled = np.clip(np.rint((arr - SCALE_RANGE[0]) * scale), 0, 255).astype(np.uint8)
+        dst_band.WriteArray(scaled, 0, yoff)
+
+        in_strip = (browse_rows >= yoff) & (browse_rows < yoff + rows)
+        browse[in_strip] = scaled[browse_rows[in_strip] - yoff][:, browse_cols]
+    dst_ds.FlushCache()
+    dst_ds = None
+
+    logging.info("Creating browse png from %s" % outfile)
+    mem_ds = gdal.GetDriverByName('MEM').Create('', browse.shape[1], browse.shape[0], 1, gdal.GDT_Byte)
+    mem_ds.GetRasterBand(1).WriteArray(browse)
+    mem_ds.GetRasterBand(1).SetNoDataValue(0)
+    gdal.GetDriverByName('PNG').CreateCopy(os.path.splitext(outfile)[0] + '.browse.png', mem_ds)
+    _write_thumbnail(os.path.splitext(outfile)[0] + '.browse_small.png', mem_ds)
     return outfile
 
 
-def create_tiled_layer(output_dir, tiff_file, zoom=[0, 8]):
-    """Use extracted data to create tiles for display on tosca"""
+def _native_max_zoom(tiff_file):
+    """Mercator zoom level at which tiles reach the native resolution of tiff_file."""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    warped = gdal.AutoCreateWarpedVRT(gdal.Open(tiff_file), None, srs.ExportToWkt())
+    res = abs(warped.GetGeoTransform()[1])
+    return int(math.ceil(math.log(2 * math.pi * 6378137 / (256 * res), 2)))
+
+
+def _build_overviews(tiff_file):
+    """Build an external overview pyramid (.ovr) so low zoom levels read decimated
+       data instead of the full resolution raster."""
+    ds = gdal.Open(tiff_file, gdal.GA_ReadOnly)
+    levels = []
+    factor = 2
+    while min(ds.RasterXSize, ds.RasterYSize) // factor >= 256:
+        levels.append(factor)
+        factor *= 2
+    if levels and ds.GetRasterBand(1).GetOverviewCount() == 0:
+        logging.info("Building overviews %s for %s" % (levels, tiff_file))
+        ds.BuildOverviews('AVERAGE', levels)
+
+
+def _run_gdal2tiles(argv):
+    try:
+        from osgeo_utils import gdal2tiles
+    except ImportError:
+        cmd = " ".join(["gdal2tiles.py"] + argv[1:])
+        logging.info("cmd: %s" % cmd)
+        check_call(cmd, shell=True)
+        return
+    logging.info("gdal2tiles: %s" % " ".join(argv[1:]))
+    ret = gdal2tiles.main(argv)
+    if ret:
+        raise RuntimeError("gdal2tiles returned %s" % ret)
+
+
+def create_tiled_layer(output_dir, tiff_file, zoom=[0, TILE_MAX_ZOOM], processes=TILE_PROCESSES):
+    """Use extracted data to create tiles for display on tosca.
+       Tiles are rendered in parallel by gdal2tiles; after a failure only the
+       missing tiles are resumed, at one zoom level less.
+       Returns the max zoom level that was generated, None if tiling failed."""
     # create tiles from geotiff for facetView dispaly
     logging.info("Generating tiles.")
     zoom_i = zoom[0]
-    zoom_f = zoom[1]
-
-    while zoom_f > zoom_i:
+    zoom_f = min(zoom[1], _native_max_zoom(tiff_file))
+    _build_overviews(tiff_file)
+
+    resume = False
+    while zoom_f >= zoom_i:
+        argv = ["gdal2tiles.py", "-z", "{}-{}".format(zoom_i, zoom_f), "-p", "mercator", "-a", "0,0,0",
+                "--processes={}".format(processes)]
+        if resume:
+            argv.append("-e")
+        argv += [tiff_file, output_dir]
         try:
-            cmd = "gdal2tiles.py -z {}-{} -p mercator -a 0,0,0 {} {}".format(zoom_i, zoom_f, tiff_file, output_dir)
-            logging.info("cmd: %s" % cmd)
-            check_call(cmd, shell=True)
-            break
-        except Exception as e:
-            logging.warn("Got exception running {}: {}".format(cmd, str(e)))
+            _run_gdal2tiles(argv)
+            return zoom_f
+        except (Exception, SystemExit) as e:
+            logging.warn("Got exception running {}: {}".format(" ".join(argv), str(e)))
             logging.warn("Traceback: {}".format(traceback.format_exc()))
+            resume = True
             zoom_f -= 1
+    return None
 
 
 def create_product_browse(file):
     """Use extracted data to create browse images for display on tosca"""
-    options_string = '-of PNG'
+    options = {'format': 'PNG'}
     if "tif" in file:
         # tiff files are huge, our options need to resize them
-        options_string += ' -outsize 10% 10%'
+        options.update(widthPct=BROWSE_PCT, heightPct=BROWSE_PCT)
     elif "WBD" in file:
         # scansar L1.1 images have 1:7 aspect ratio
-        options_string += ' -outsize 100% 40%'
+        options.update(widthPct=100, heightPct=40)
 
     logging.info("Creating browse png from %s" % file)
     out_file = os.path.splitext(file)[0] + '.browse.png'
     out_file_small = os.path.splitext(file)[0] + '.browse_small.png'
-    gdal_translate(out_file, file, options_string)
-    os.system("convert -resize 250x250 %s %s" % (out_file, out_file_small))
+    browse_ds = gdal.Translate(out_file, file, **options)
+    _write_thumbnail(out_file_small, browse_ds)
     return
 
 
+def process_polarisation(tif_file_path, tile_dir=None, need_swath_poly=False):
+    """Create the display geotiff and browse pngs of one polarisation, plus its tile
+       layer when tile_dir is given and its swath polygon when need_swath_poly.
+       Returns (tile max zoom, footprint coordinates), None for anything not made."""
+    # process the geotiff to remove nodata, the browse pngs are created along with it
+    processed_tif_disp = process_geotiff_disp(tif_file_path)
+
+    tile_max_zoom = None
+    if tile_dir:
+        # TODO: are tiles necessary?
+        tile_max_zoom = create_tiled_layer(tile_dir, processed_tif_disp)
+
+    # create kmz
+    # create_product_kmz(processed_tif_disp)
+
+    # create swath polygon from the valid data boundary
+    # (gdal_polygonize gave many polygons in mountaineous regions, e.g. Typhoon Hagibis, 20191019)
+    coordinates = getFootprintJson(processed_tif_disp) if need_swath_poly else None
+    return tile_max_zoom, coordinates
+
+
 def productize(dataset_name, raw_dir, download_source):
     """Use extracted data to create metadata and the ALOS2 L1.1/L1.5/L2.1 product"""
     metadata, dataset, proddir = alos2_utils.create_product_base(raw_dir, dataset_name)
@@ -159,7 +314,7 @@ def productize(dataset_name, raw_dir, download_source):
         shutil.move(raw_dir_zipped, archive_filename)
     else:
         logging.info("Zipfile of raw_dir not found. Repackaging contents of %s to %s" % (raw_dir, archive_filename))
-        shutil.make_archive(os.path.splitext(archive_filename)[0], 'zip', raw_dir)
+        alos2_utils.make_product_archive(raw_dir, archive_filename)
 
     if alos2_utils.ALOS2_L11 in dataset_name:
         # create browse only for L1.1 data (if available)
@@ -171,44 +326,38 @@ def productize(dataset_name, raw_dir, download_source):
     else:
         # create post products (tiles) for L1.5 / L2.1 data
         tiff_regex = re.compile("IMG-([A-Z]{2})-ALOS2(.{27}).tif")
-        tiff_files = [f for f in os.listdir(raw_dir) if tiff_regex.match(f)]
+        tiff_files = sorted(f for f in os.listdir(raw_dir) if tiff_regex.match(f))
 
         tile_md = {"tiles": True, "tile_layers": [], "tile_max_zoom": []}
 
         # we need to override the coordinates bbox to cover actual swath if dataset is Level2.1
         # L2.1 is Geo-coded (Map projection based on north-oriented map direction)
-        # need_swath_poly = "2.1" in dataset_name
+        need_swath_poly = alos2_utils.ALOS2_L21 in dataset_name
         tile_output_dir = "{}/tiles/".format(proddir)
-
-        for tf in tiff_files:
-            tif_file_path = os.path.join(raw_dir, tf)
-            # process the geotiff to remove nodata
-            processed_tif_disp = process_geotiff_disp(tif_file_path)
-
-            # create the layer for facet view (only one layer created)
-            if not os.path.isdir(tile_output_dir):
-                # TODO: are tiles necessary?
-                tile_max_zoom = 8
+        # only one layer is created for facet view, from the first polarisation
+        need_tiles = not os.path.isdir(tile_output_dir)
+
+        # polarisations are independent, process them concurrently
+        # scenes run on threads that may hold GDAL / IO locks, never fork them into the workers
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(POL_WORKERS, len(tiff_files))),
+                                                    mp_context=multiprocessing.get_context("forkserver")) as executor:
+            futures = []
+            for i, tf in enumerate(tiff_files):
                 layer = tiff_regex.match(tf).group(1)
-                create_tiled_layer(os.path.join(tile_output_dir, layer), processed_tif_disp, zoom=[0, tile_max_zoom])
-                tile_md["tile_layers"].append(layer)
-                tile_md["tile_max_zoom"].append(tile_max_zoom)
-
-            # create the browse pngs
-            create_product_browse(processed_tif_disp)
-
-            # create kmz
-            # create_product_kmz(processed_tif_disp)
-
-            # create swath polygon from gdal_polygonize,
-            # UPDATE: 20191019, this does not work well in mountaineous regions! We saw this when ingesting data for Typhoon Hagibis: There were many polygons detected instead of 1.
-            # if need_swath_poly:
-            #     coordinates = getFootprintJson(processed_tif_disp)
-            #     # Override cooirdinates from summary.txt
-            #     metadata['location']['coordinates'] = [coordinates]
-            #     dataset['location']['coordinates'] = [coordinates]
-            #     # do this once only
-            #     need_swath_poly = False
+                tile_dir = os.path.join(tile_output_dir, layer) if need_tiles and i == 0 else None
+                futures.append(executor.submit(process_polarisation, os.path.join(raw_dir, tf), tile_dir,
+                                               need_swath_poly and i == 0))
+
+            # merge in polarisation order so the metadata is deterministic
+            for tf, future in zip(tiff_files, futures):
+                tile_max_zoom, coordinates = future.result()
+                if tile_max_zoom is not None:
+                    tile_md["tile_layers"].append(tiff_regex.match(tf).group(1))
+                    tile_md["tile_max_zoom"].append(tile_max_zoom)
+                if coordinates is not None:
+                    # Override cooirdinates from summary.txt
+                    metadata['location']['coordinates'] = [coordinates]
+                    dataset['location']['coordinates'] = [coordinates]
 
         # udpate the tiles
         metadata.update(tile_md)
@@ -223,46 +372,178 @@ def productize(dataset_name, raw_dir, download_source):
 
     return metadata, dataset, proddir
 
-def ingest_alos2(download_source):
-    """Download file, push to repo and submit job for extraction."""
-
-    pri_zip_paths = glob.glob('*.zip')
-    # sec_zip_files = []
-    for pri_zip_path in pri_zip_paths:
-        alos2_utils.extract_nested_zip(pri_zip_path)
+def ingest_alos2(download_source, unzip_dirs=None, workers=None, disk_budget=None):
+    """Download file, push to repo and submit job for extraction.
+       unzip_dirs lists primary zips that were already extracted while downloading.
+       Scenes are productized concurrently, see ingest_scenes."""
 
     raw_dir_list = []
-    for root, subFolders, files in os.walk(os.getcwd()):
-        if files:
-            for x in files:
-                m = re.search("IMG-[A-Z]{2}-ALOS2.{05}(.{04}-\d{6})-.{4}.*", x)
-                if m:
-                    logging.info("We found a ALOS2 dataset directory in: %s, adding to list" % root)
-                    raw_dir_list.append(root)
-                    break
-
-    for raw_dir in raw_dir_list:
-        dataset_name = alos2_utils.extract_dataset_name(raw_dir)
-        # productize our extracted data
-        metadata, dataset, proddir = productize(dataset_name, raw_dir, download_source)
-
-        # dump metadata
-        with open(os.path.join(proddir, dataset_name + ".met.json"), "w") as f:
-            json.dump(metadata, f, indent=2)
-            f.close()
-
-        # dump dataset
-        with open(os.path.join(proddir, dataset_name + ".dataset.json"), "w") as f:
-            json.dump(dataset, f, indent=2)
-            f.close()
+    if unzip_dirs is None:
+        pri_zip_paths = glob.glob('*.zip')
+        # sec_zip_files = []
+        for pri_zip_path in pri_zip_paths:
+            raw_dir_list.extend(alos2_utils.extract_nested_zip(pri_zip_path))
+    else:
+        for unzip_dir in unzip_dirs:
+            raw_dir_list.extend(alos2_utils.extract_inner_zips(unzip_dir))
+    # the extraction manifest already lists every scene directory, no need to walk cwd
+    raw_dir_list = sorted(set(raw_dir_list))
 
-        # cleanup raw_dir
-        shutil.rmtree(raw_dir, ignore_errors=True)
+    failures = ingest_scenes(raw_dir_list, download_source, workers=workers, disk_budget=disk_budget)
 
     # cleanup downloaded zips in cwd
     for file in glob.glob('*.zip'):
         os.remove(file)
 
+    if failures:
+        raise RuntimeError("Failed to productize {} of {} scenes: {}".format(
+            len(failures), len(raw_dir_list), json.dumps(failures, indent=2)))
+
+
+def _parse_size(size):
+    """Bytes in a job-spec style size string, e.g. 200GB."""
+    m = re.match(r"^\s*([\d.]+)\s*([KMGT]?)B?\s*$", str(size).upper())
+    if not m:
+        raise RuntimeError("Unable to parse disk size: %s" % size)
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2) or " "))
+
+
+def _job_disk_usage():
+    """disk_usage of the job-spec this job runs with, from _context.json"""
+    if not os.path.exists('_context.json'):
+        return None
+    return load_context().get('job_specification', {}).get('disk_usage')
+
+
+def _dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fp = os.path.join(root, f)
+            if not os.path.islink(fp):
+                total += os.path.getsize(fp)
+    return total
+
+
+def ingest_scene(raw_dir, dataset_name, download_source, cleanup=True):
+    """Productize one scene directory and dump its met.json / dataset.json."""
+    # productize our extracted data
+    metadata, dataset, proddir = productize(dataset_name, raw_dir, download_source)
+
+    # dump metadata
+    with open(os.path.join(proddir, dataset_name + ".met.json"), "w") as f:
+        json.dump(metadata, f, indent=2)
+        f.close()
+
+    # dump dataset
+    with open(os.path.join(proddir, dataset_name + ".dataset.json"), "w") as f:
+        json.dump(dataset, f, indent=2)
+        f.close()
+
+    # record the scene in the local index, so later jobs skip it
+    index = scene_index.open_index()
+    if index:
+        try:
+            index.add(metadata, dataset, os.path.join(proddir, dataset_name + ".met.json"))
+        except Exception as e:
+            logging.warning("Unable to add %s to the scene index: %s" % (dataset_name, str(e)))
+        finally:
+            index.close()
+
+    # cleanup raw_dir
+    if cleanup:
+        shutil.rmtree(raw_dir, ignore_errors=True)
+    return proddir
+
+
+def ingest_scenes(raw_dir_list, download_source, workers=None, disk_budget=None):
+    """Productize scene directories concurrently.
+       A scene is only started if its estimated extra disk usage (about the size of its
+       raw data, for the archive and display products) fits in what is left of the disk
+       budget; at least one scene always runs. A scene with other scenes nested in it
+       only starts once they are done. Scenes already produced at the current dataset
+       version are skipped and removed. Failures are isolated per scene.
+       Returns a dict of raw_dir -> error for the scenes that failed."""
+    workers = workers or int(os.environ.get('ALOS2_SCENE_WORKERS', 0)) or SCENE_WORKERS
+    disk_budget = disk_budget or os.environ.get('ALOS2_DISK_BUDGET') or _job_disk_usage() or DISK_BUDGET
+    budget = _parse_size(disk_budget) - _dir_size(os.getcwd())
+    budget = min(budget, shutil.disk_usage(os.getcwd()).free)
+
+    failures = {}
+    queue = []
+    seen = {}
+    for raw_dir in raw_dir_list:
+        try:
+            dataset_name = alos2_utils.extract_dataset_name(raw_dir)
+        except Exception as e:
+            logging.error("Unable to get dataset name of %s: %s" % (raw_dir, str(e)))
+            failures[raw_dir] = str(e)
+            continue
+        if dataset_name in seen:
+            logging.warning("Skipping %s, %s already found in %s" % (raw_dir, dataset_name, seen[dataset_name]))
+            continue
+        seen[dataset_name] = raw_dir
+        # scene directories nested in or around other scenes are removed at the end, the outer
+        # scene still archives the inner ones and the inner ones may resolve to its zip
+        nested = any(other.startswith(raw_dir + os.path.sep) or raw_dir.startswith(other + os.path.sep)
+                     for other in raw_dir_list)
+        queue.append((raw_dir, dataset_name, _dir_size(raw_dir), nested))
+
+    deferred_cleanup = []
+    # only skip scenes made with the current dataset version, a version bump reprocesses them
+    produced = ingest_alos2_md.produced_versions(dataset_name for _, dataset_name, _, _ in queue)
+    current = [q for q in queue if produced.get(q[1]) == alos2_utils.dataset_version(q[1])]
+    for raw_dir, dataset_name, _, nested in current:
+        logging.info("Skipping %s, %s %s was already produced" % (raw_dir, dataset_name, produced[dataset_name]))
+        # release their disk now, it counts against the budget of the scenes still to run
+        if nested:
+            deferred_cleanup.append(raw_dir)
+        else:
+            shutil.rmtree(raw_dir, ignore_errors=True)
+            if os.path.isfile(raw_dir + ".zip"):
+                os.remove(raw_dir + ".zip")
+    queue = [q for q in queue if q not in current]
+
+    def ready(raw_dir):
+        # a scene starts after the scenes nested in it, productize moves its zip away
+        prefix = raw_dir + os.path.sep
+        return not any(other.startswith(prefix) for other, _, _, _ in queue) and \
+            not any(other.startswith(prefix) for other, _, _ in in_flight.values())
+
+    in_flight = {}
+    reserved = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while queue or in_flight:
+            while queue and len(in_flight) < workers:
+                i = next((i for i, q in enumerate(queue) if ready(q[0])), None)
+                if i is None:
+                    break
+                raw_dir, dataset_name, need, nested = queue[i]
+                if in_flight and reserved + need > budget:
+                    break
+                queue.pop(i)
+                reserved += need
+                logging.info("Productizing %s from %s (%s scenes waiting, %.1f of %.1f GB reserved)"
+                             % (dataset_name, raw_dir, len(queue), reserved / 1024.0 ** 3, budget / 1024.0 ** 3))
+                future = executor.submit(ingest_scene, raw_dir, dataset_name, download_source, not nested)
+                in_flight[future] = (raw_dir, need, nested)
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                raw_dir, need, nested = in_flight.pop(future)
+                reserved -= need
+                try:
+                    future.result()
+                    if nested:
+                        deferred_cleanup.append(raw_dir)
+                except Exception as e:
+                    logging.error("Failed to productize %s: %s" % (raw_dir, traceback.format_exc()))
+                    failures[raw_dir] = str(e)
+
+    for raw_dir in deferred_cleanup:
+        shutil.rmtree(raw_dir, ignore_errors=True)
+    return failures
+
 def load_context():
     with open('_context.json') as data_file:
         data = json.load(data_file)
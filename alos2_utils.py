@@ -2,57 +2,686 @@
 
 import re
 import zipfile
-import configparser
-import io
+import struct
+import threading
+import zlib
 import datetime, os, json, logging, traceback
-from subprocess import check_call, check_output
+import concurrent.futures
+from urllib.parse import urlparse
 import glob
+import copy
+import functools
+import shutil
+import tempfile
+import time
+import calendar
+import sys
+import requests
+import numpy as np
+import alos2_cache
+from scripts import extract_alos2_md
 ALOS2_L11 = "1.1"
 ALOS2_L15 = "1.5"
 ALOS2_L21 = "2.1"
 
+# segmented download settings
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_SEGMENT_SIZE = 64 * 1024 * 1024
+DOWNLOAD_CHUNK = 1024 * 1024
+# a segment cut off mid-transfer is re-requested from where it stopped
+SEGMENT_RETRIES = 4
+SEGMENT_BACKOFF = 2
+# (connect, read) timeout of every download request, a stalled connection fails and is retried
+DOWNLOAD_TIMEOUT = (60, 300)
+
+# streaming unzip settings
+STREAM_CHUNK = 1024 * 1024
+ZIP_LOCAL_SIG = b'PK\x03\x04'
+ZIP_DESCRIPTOR_SIG = b'PK\x07\x08'
+EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+NESTED_ZIP_WORKERS = 4
+
+# product archive members with these extensions are stored, not deflated
+ARCHIVE_STORED_EXTS = ('.tif', '.tiff', '.jpg', '.jpeg', '.png', '.zip', '.gz', '.kmz')
+
+# any directory holding an IMG file like this is an ALOS2 scene directory
+SCENE_IMG_REGEX = re.compile(r"IMG-[A-Z]{2}-ALOS2.{05}(.{04}-\d{6})-.{4}.*")
+
+# ALOS2 product names, e.g. ALOS2011482800-140609-FBDR1.1__A, decoded by decode_scene_names
+SCENE_NAME_LEN = 32
+SCENE_ID_LEN = 21
+
+def _write_pge_metrics(url, path, time_start, time_end, output="./pge_metrics.json"):
+    """Record download metrics in the same shape osaka's measure=True produced."""
+    duration = (time_end - time_start).total_seconds()
+    disk_usage = os.path.getsize(path)
+    metrics = {"download": [], "upload": []}
+    if os.path.exists(output):
+        with open(output) as f:
+            metrics = json.load(f)
+    metrics.setdefault("download", []).append({
+        "url": url,
+        "path": path,
+        "disk_usage": disk_usage,
+        "time_start": time_start.isoformat() + 'Z',
+        "time_end": time_end.isoformat() + 'Z',
+        "duration": duration,
+        "transfer_rate": disk_usage / duration if duration else 0
+    })
+    with open(output, 'w') as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+
+
+def _download_session(pool_size):
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=3)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+def _probe_range(session, download_url):
+    """Returns the total size of download_url if the server honours Range requests, else None."""
+    r = session.get(download_url, headers={"Range": "bytes=0-0"}, stream=True, verify=False, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        r.raise_for_status()
+        content_range = r.headers.get('Content-Range', '')
+        if r.status_code == 206 and '/' in content_range:
+            total = content_range.rsplit('/', 1)[-1]
+            if total.isdigit():
+                return int(total)
+    finally:
+        r.close()
+    return None
+
+
+def _download_segment(session, download_url, fd, start, end):
+    """Fetch bytes start-end (inclusive) of download_url and pwrite them into fd at their offset.
+       A dropped connection is retried from the last byte written, with backoff."""
+    offset = start
+    attempt = 0
+    while True:
+        headers = {"Range": "bytes=%s-%s" % (offset, end)}
+        try:
+            with session.get(download_url, headers=headers, stream=True, verify=False,
+                             timeout=DOWNLOAD_TIMEOUT) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise RuntimeError("Server ignored range request for %s (status %s)" % (download_url, r.status_code))
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                    while chunk:
+                        written = os.pwrite(fd, chunk, offset)
+                        offset += written
+                        chunk = chunk[written:]
+            if offset == end + 1:
+                return
+            error = "short read, got bytes %s-%s of %s-%s" % (start, offset - 1, start, end)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            error = str(e)
+        attempt += 1
+        if attempt > SEGMENT_RETRIES:
+            raise RuntimeError("Failed to download bytes %s-%s of %s: %s" % (start, end, download_url, error))
+        wait = SEGMENT_BACKOFF * 2 ** (attempt - 1)
+        logging.warning("Segment %s-%s of %s interrupted at %s (%s), retrying in %s s."
+                        % (start, end, download_url, offset, error, wait))
+        time.sleep(wait)
+
+
+def _download_stream(session, download_url, dest):
+    with session.get(download_url, stream=True, verify=False, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        with open(dest, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                f.write(chunk)
+
+
+def download_segmented(download_url, dest, workers=None, segment_size=None):
+    """Download download_url to dest over concurrent HTTP Range segments.
+       Falls back to a single stream when the server does not support ranges."""
+    workers = workers or DOWNLOAD_WORKERS
+    segment_size = segment_size or DOWNLOAD_SEGMENT_SIZE
+    with _download_session(workers) as session:
+        total = _probe_range(session, download_url)
+        if total is None or total <= segment_size:
+            logging.info("Range requests not used for %s, downloading in a single stream." % download_url)
+            _download_stream(session, download_url, dest)
+            return
+
+        segments = [(start, min(start + segment_size, total) - 1) for start in range(0, total, segment_size)]
+        logging.info("Downloading %s bytes in %s segments with %s workers." % (total, len(segments), workers))
+        fd = os.open(dest, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # preallocate so every segment can be written in place
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, total)
+            else:
+                os.ftruncate(fd, total)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_download_segment, session, download_url, fd, start, end)
+                           for start, end in segments]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        finally:
+            os.close(fd)
+
+
 def download(download_url):
     # download
     dest = os.path.basename(download_url)
     logging.info("Downloading %s to %s." % (download_url, dest))
     try:
-        cmd = "python -c \'import osaka.main; osaka.main.get(\"%s\", \"%s\", params={\"oauth\": None}, measure=True, output=\"./pge_metrics.json\")\'" % (download_url, dest)
-        logging.info(cmd)
-        check_output(cmd, shell=True)
+        time_start = datetime.datetime.utcnow()
+        if urlparse(download_url).scheme in ('http', 'https'):
+            download_segmented(download_url, dest)
+        else:
+            # non-http sources (e.g. s3://) still go through osaka, but in-process
+            import osaka.main
+            osaka.main.get(download_url, dest, params={"oauth": None})
+        _write_pge_metrics(download_url, os.path.abspath(dest), time_start, datetime.datetime.utcnow())
     except Exception as e:
         tb = traceback.format_exc()
         logging.error("Failed to download %s to %s: %s" % (download_url,
                                                            dest, tb))
         raise
 
+def _set_member_mtime(path, date_time):
+    """Give an extracted file the member's timestamp from the zip rather than the time of extraction,
+       so the metadata cache fingerprint of a scene is the same every time it is extracted"""
+    try:
+        t = calendar.timegm(tuple(date_time) + (0, 0, 0))
+        os.utime(path, (t, t))
+    except (ValueError, OverflowError, OSError) as e:
+        logging.warning("Unable to set the mtime of %s: %s" % (path, e))
+
+
+def _extract_member(zip_file, info, unzip_dir):
+    """Extract a single member, relying on ZipExtFile to check its CRC as it is read.
+       The partial output is removed if the member turns out to be corrupt."""
+    out_path = _zip_member_path(unzip_dir, info.filename)
+    try:
+        with zipfile.ZipFile(zip_file, 'r') as f, f.open(info) as src, open(out_path, 'wb') as out:
+            shutil.copyfileobj(src, out, STREAM_CHUNK)
+    except (zipfile.BadZipFile, zlib.error):
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise RuntimeError("%s is corrupt. Test zip returns: %s" % (zip_file, info.filename))
+    _set_member_mtime(out_path, info.date_time)
+    return out_path
+
+
 def verify_and_extract(zip_file):
     """Verify downloaded file is okay by checking that it can
-       be unzipped/untarred."""
+       be unzipped/untarred. CRCs are checked while members are extracted."""
     unzip_dir = None
     if not zipfile.is_zipfile(zip_file):
         raise RuntimeError("%s is not a zipfile." % zip_file)
     with zipfile.ZipFile(zip_file, 'r') as f:
-        ret = f.testzip()
-        if ret:
-            raise RuntimeError("%s is corrupt. Test zip returns: %s" % (zip_file, ret))
+        members = f.infolist()
+    unzip_dir = os.path.abspath(zip_file.replace(".zip", ""))
+
+    # create the directory tree up front so workers never race on makedirs
+    files = []
+    for info in members:
+        out_path = _zip_member_path(unzip_dir, info.filename)
+        if info.is_dir():
+            os.makedirs(out_path, exist_ok=True)
         else:
-            unzip_dir = os.path.abspath(zip_file.replace(".zip", ""))
-            f.extractall(unzip_dir)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            files.append(info)
+
+    # zlib releases the GIL, so members decompress in parallel on threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+        futures = [executor.submit(_extract_member, zip_file, info, unzip_dir) for info in files]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
     return unzip_dir
 
+def _scan_extracted(top):
+    """Scan a freshly extracted tree once with os.scandir.
+       Returns the inner zip files and the ALOS2 scene directories found in it."""
+    zips = []
+    scene_dirs = []
+    stack = [top]
+    while stack:
+        current = stack.pop()
+        is_scene = False
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.zip'):
+                    zips.append(entry.path)
+                elif not is_scene and SCENE_IMG_REGEX.search(entry.name):
+                    is_scene = True
+        if is_scene:
+            logging.info("We found a ALOS2 dataset directory in: %s, adding to list" % current)
+            scene_dirs.append(current)
+    return zips, scene_dirs
+
+
+def _extract_and_scan(zippedFile):
+    logging.info("extracting %s"  % zippedFile)
+    unzip_dir = verify_and_extract(zippedFile)
+    return _scan_extracted(unzip_dir)
+
+
+def _drain_zip_queue(zips, scene_dirs):
+    """Extract zips, and any zips found inside them, on a bounded pool.
+       Each extracted tree is scanned exactly once, by the job that created it."""
+    scene_dirs = list(scene_dirs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NESTED_ZIP_WORKERS) as executor:
+        pending = set(executor.submit(_extract_and_scan, z) for z in zips)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                inner_zips, found = future.result()
+                scene_dirs.extend(found)
+                for inner_zip in inner_zips:
+                    logging.info("submitting zip file extraction %s"  % inner_zip)
+                    pending.add(executor.submit(_extract_and_scan, inner_zip))
+    return sorted(set(scene_dirs))
+
+
 def extract_nested_zip(zippedFile):
     """ Extract a zip file including any nested zip files
-        Delete the zip file(s) after extraction
+        Returns the ALOS2 scene directories found in the extracted tree
+    """
+    return _drain_zip_queue([zippedFile], [])
+
+
+def extract_inner_zips(unzip_dir):
+    """ Extract any zip files nested in an already extracted directory
+        Returns the ALOS2 scene directories found in the extracted tree
     """
-    logging.info("extracting %s"  % zippedFile)
-    unzip_dir = verify_and_extract(zippedFile)
     logging.info("walking through %s"  % unzip_dir)
-    for root, dirs, files in os.walk(unzip_dir):
-        for filename in files:
-            if re.search(r'\.zip$', filename):
-                fileSpec = os.path.join(root, filename)
-                logging.info("submitting zip file extraction %s"  % fileSpec)
-                extract_nested_zip(fileSpec)
+    zips, scene_dirs = _scan_extracted(unzip_dir)
+    return _drain_zip_queue(zips, scene_dirs)
+
+
+class GrowingFile(object):
+    """Sequential reader over a file that is still being written to.
+       Reads block until the writer has advanced past the requested bytes
+       or has called finish()."""
+
+    def __init__(self, path):
+        self.name = path
+        self._fp = open(path, 'rb')
+        self._cond = threading.Condition()
+        self._size = 0
+        self._done = False
+        self._pushback = b''
+
+    def advance(self, size):
+        with self._cond:
+            self._size = size
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def unread(self, data):
+        self._pushback = data + self._pushback
+
+    def read(self, n):
+        data = self._pushback[:n]
+        self._pushback = self._pushback[n:]
+        n -= len(data)
+        if n > 0:
+            target = self._fp.tell() + n
+            with self._cond:
+                while self._size < target and not self._done:
+                    self._cond.wait()
+            data += self._fp.read(n)
+        return data
+
+    def close(self):
+        self._fp.close()
+
+
+def _zip_member_path(unzip_dir, name):
+    """Sanitised output path for a zip member, following ZipFile.extract's rules."""
+    arcname = name.replace('/', os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [x for x in arcname.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(unzip_dir, *parts)
+
+
+def _stream_member(src, out_path, method, csize, has_descriptor):
+    """Write one member from src to out_path, returning (crc, compressed_size)."""
+    crc = 0
+    consumed = 0
+    decomp = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+    with open(out_path, 'wb') as out:
+        while True:
+            if has_descriptor:
+                # sizes unknown up front, decompress until the deflate stream ends
+                if decomp.eof:
+                    break
+                chunk = src.read(STREAM_CHUNK)
+            else:
+                if consumed >= csize:
+                    break
+                chunk = src.read(min(STREAM_CHUNK, csize - consumed))
+            if not chunk:
+                raise RuntimeError("Unexpected end of stream while extracting %s" % out_path)
+            consumed += len(chunk)
+            data = decomp.decompress(chunk) if decomp else chunk
+            if decomp and decomp.unused_data:
+                src.unread(decomp.unused_data)
+                consumed -= len(decomp.unused_data)
+            crc = zlib.crc32(data, crc)
+            out.write(data)
+        if decomp:
+            data = decomp.flush()
+            crc = zlib.crc32(data, crc)
+            out.write(data)
+    return crc, consumed
+
+
+def _stream_extract(src, unzip_dir, extracted):
+    """Extract members from the local headers in src as they arrive.
+       Verified members are recorded in extracted as name -> crc. Stops at the
+       central directory, or at any member that cannot be streamed, leaving the
+       remainder to be extracted from the finished file."""
+    while True:
+        sig = src.read(4)
+        if sig != ZIP_LOCAL_SIG:
+            return
+        (version, flags, method, mtime, mdate, crc, csize, usize,
+         fnlen, extralen) = struct.unpack('<5H3L2H', src.read(26))
+        name = src.read(fnlen).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = src.read(extralen)
+        zip64 = False
+        while len(extra) >= 4:
+            tag, size = struct.unpack('<2H', extra[:4])
+            if tag == 0x0001:
+                zip64 = True
+                values = list(struct.unpack('<%dQ' % (size // 8), extra[4:4 + size - size % 8]))
+                if usize == 0xFFFFFFFF:
+                    usize = values.pop(0)
+                if csize == 0xFFFFFFFF:
+                    csize = values.pop(0)
+            extra = extra[4 + size:]
+
+        has_descriptor = bool(flags & 0x08)
+        if flags & 0x01 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) \
+                or (has_descriptor and method == zipfile.ZIP_STORED):
+            logging.info("Unable to stream %s, leaving it for the central directory pass" % name)
+            return
+
+        out_path = _zip_member_path(unzip_dir, name)
+        if name.endswith('/'):
+            os.makedirs(out_path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        try:
+            actual_crc, consumed = _stream_member(src, out_path, method, csize, has_descriptor)
+        except zlib.error as e:
+            os.remove(out_path)
+            raise RuntimeError("%s is corrupt. Unable to decompress %s: %s" % (src.name, name, e))
+
+        if has_descriptor:
+            descriptor = src.read(4)
+            if descriptor != ZIP_DESCRIPTOR_SIG:
+                src.unread(descriptor)
+            crc, = struct.unpack('<L', src.read(4))
+            src.read(16 if zip64 else 8)
+
+        if actual_crc != crc:
+            os.remove(out_path)
+            raise RuntimeError("%s is corrupt. Bad CRC-32 for file: %s" % (src.name, name))
+        # DOS date and time, as ZipInfo.date_time decodes them
+        _set_member_mtime(out_path, ((mdate >> 9) + 1980, (mdate >> 5) & 0xF, mdate & 0x1F,
+                                     mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2))
+        extracted[name] = actual_crc
+
+
+def _stream_download(session, download_url, f, src):
+    """Write download_url to f as it arrives, advancing src past every chunk written.
+       A dropped or stalled connection is resumed with a Range request from the bytes
+       already written, with backoff. Returns False, leaving the file incomplete, if the
+       server does not honour the resume."""
+    written = 0
+    total = None
+    attempt = 0
+    while True:
+        headers = {"Range": "bytes=%s-" % written} if written else {}
+        try:
+            with session.get(download_url, headers=headers, stream=True, verify=False,
+                             timeout=DOWNLOAD_TIMEOUT) as r:
+                r.raise_for_status()
+                if written:
+                    m = re.match(r'bytes (\d+)-\d+/(\d+)', r.headers.get('Content-Range', ''))
+                    if r.status_code != 206 or not m or int(m.group(1)) != written:
+                        return False
+                    total = int(m.group(2))
+                elif 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+                    total = int(r.headers['Content-Length'])
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                    f.write(chunk)
+                    written += len(chunk)
+                    src.advance(written)
+            if total is None or written == total:
+                return True
+            error = "short read, got %s of %s bytes" % (written, total)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            error = str(e)
+        attempt += 1
+        if attempt > SEGMENT_RETRIES:
+            raise RuntimeError("Failed to download %s: %s" % (download_url, error))
+        wait = SEGMENT_BACKOFF * 2 ** (attempt - 1)
+        logging.warning("Download of %s interrupted at %s (%s), retrying in %s s."
+                        % (download_url, written, error, wait))
+        time.sleep(wait)
+
+
+def download_and_extract(download_url):
+    """Download download_url while extracting its members as the bytes arrive.
+       Each member's CRC is checked as it is written, and the central directory
+       is used at the end to confirm (or finish) the extraction."""
+    dest = os.path.basename(download_url)
+    if urlparse(download_url).scheme not in ('http', 'https'):
+        download(download_url)
+        return verify_and_extract(dest)
+
+    logging.info("Downloading and extracting %s to %s." % (download_url, dest))
+    unzip_dir = os.path.abspath(dest.replace(".zip", ""))
+    extracted = {}
+    errors = []
+    time_start = datetime.datetime.utcnow()
+    with _download_session(1) as session, open(dest, 'wb', buffering=0) as f:
+        src = GrowingFile(dest)
+
+        def consume():
+            try:
+                _stream_extract(src, unzip_dir, extracted)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # keep draining so the downloader is never blocked on us
+                src.finish()
+
+        extractor = threading.Thread(target=consume)
+        extractor.start()
+        try:
+            resumed = _stream_download(session, download_url, f, src)
+        finally:
+            src.finish()
+            extractor.join()
+            src.close()
+
+    if resumed:
+        _write_pge_metrics(download_url, os.path.abspath(dest), time_start, datetime.datetime.utcnow())
+    else:
+        # the extractor stopped at the end of what had arrived, the members it verified are kept
+        # and the central directory pass below extracts the rest from the full download
+        logging.warning("%s cannot be resumed, downloading it again without streaming." % download_url)
+        errors = []
+        download(download_url)
+    if errors:
+        raise errors[0]
+
+    if not zipfile.is_zipfile(dest):
+        raise RuntimeError("%s is not a zipfile." % dest)
+    with zipfile.ZipFile(dest, 'r') as zf:
+        for info in zf.infolist():
+            if info.is_dir() or extracted.get(info.filename) == info.CRC:
+                continue
+            logging.info("Extracting %s from the central directory" % info.filename)
+            os.makedirs(os.path.dirname(_zip_member_path(unzip_dir, info.filename)), exist_ok=True)
+            _extract_member(dest, info, unzip_dir)
+    logging.info("Streamed %s members of %s while downloading" % (len(extracted), dest))
+    return unzip_dir
+
+
+def _source_zip(raw_dir):
+    """Find the zip raw_dir was extracted from (see verify_and_extract) and the
+       member prefix raw_dir corresponds to inside it."""
+    current = os.path.abspath(raw_dir)
+    prefix = ''
+    while True:
+        if os.path.isfile(current + '.zip'):
+            return current + '.zip', prefix
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None, None
+        prefix = os.path.basename(current) + '/' + prefix
+        current = parent
+
+
+def _is_incompressible(filename):
+    return filename.lower().endswith(ARCHIVE_STORED_EXTS) or os.path.basename(filename).startswith('IMG-')
+
+
+def _deflate_to_temp(path, temp_dir):
+    """Deflate path into a temp file, returning (temp file, crc, compressed size)."""
+    crc = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    tmp = tempfile.NamedTemporaryFile(dir=temp_dir, suffix='.deflate', delete=False)
+    with tmp, open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(STREAM_CHUNK), b''):
+            crc = zlib.crc32(chunk, crc)
+            tmp.write(compressor.compress(chunk))
+        tmp.write(compressor.flush())
+    return tmp.name, crc, os.path.getsize(tmp.name)
+
+
+# the public ZipFile API always compresses what it is given, so raw copies write the member
+# and update these ZipFile internals themselves; checked against CPython 3.6 to 3.13
+ZIPFILE_RAW_ATTRS = ('fp', 'filelist', 'NameToInfo', 'start_dir', '_didModify', '_writing')
+
+
+def _raw_write_supported(zf):
+    """True if zf has the internals _write_raw_member relies on"""
+    return hasattr(zipfile.ZipInfo, 'FileHeader') and all(hasattr(zf, a) for a in ZIPFILE_RAW_ATTRS)
+
+
+def _write_raw_member(zf, zinfo, src_fp, offset):
+    """Append a member whose compressed bytes are copied verbatim from src_fp.
+       zinfo must already carry CRC, compress_size, file_size and compress_type."""
+    if zf._writing or zf.fp.tell() != zf.start_dir:
+        raise RuntimeError("Unable to append %s raw, %s is not positioned at its central directory"
+                           % (zinfo.filename, zf.filename))
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    src_fp.seek(offset)
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = src_fp.read(min(STREAM_CHUNK, remaining))
+        if not chunk:
+            raise RuntimeError("Unexpected end of data copying %s" % zinfo.filename)
+        zf.fp.write(chunk)
+        remaining -= len(chunk)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+
+def _member_data_offset(src_fp, info):
+    src_fp.seek(info.header_offset)
+    header = src_fp.read(30)
+    fnlen, extralen = struct.unpack('<2H', header[26:30])
+    return info.header_offset + 30 + fnlen + extralen
+
+
+def make_product_archive(raw_dir, archive_filename):
+    """Zip the contents of raw_dir into archive_filename without recompressing
+       what we do not need to:
+         - files unchanged from the zip raw_dir was extracted from are copied raw,
+         - already-compressed / incompressible files are ZIP_STORED,
+         - everything else is deflated in parallel."""
+    source_zip, prefix = _source_zip(raw_dir)
+    source_members = {}
+    if source_zip:
+        with zipfile.ZipFile(source_zip, 'r') as f:
+            for info in f.infolist():
+                if info.filename.startswith(prefix) and not info.is_dir():
+                    source_members[info.filename[len(prefix):]] = info
+
+    raw_copy, stored, deflated = [], [], []
+    for root, dirs, files in os.walk(raw_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            arcname = os.path.relpath(path, raw_dir).replace(os.path.sep, '/')
+            info = source_members.get(arcname)
+            if info is not None and info.file_size == os.path.getsize(path) and \
+                    info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                raw_copy.append((arcname, path, info))
+            elif _is_incompressible(filename):
+                stored.append((arcname, path))
+            else:
+                deflated.append((arcname, path))
+
+    temp_dir = os.path.dirname(os.path.abspath(archive_filename))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor, \
+            zipfile.ZipFile(archive_filename, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        raw = _raw_write_supported(zf)
+        if not raw:
+            logging.warning("zipfile of Python %s lacks the internals for raw copies, recompressing %s"
+                            % (sys.version.split()[0], raw_dir))
+            for arcname, path, info in raw_copy:
+                (stored if _is_incompressible(arcname) else deflated).append((arcname, path))
+            raw_copy = []
+        logging.info("Archiving %s: %s members copied raw from %s, %s stored, %s deflated"
+                     % (raw_dir, len(raw_copy), source_zip, len(stored), len(deflated)))
+        deflate_jobs = [(arcname, path, executor.submit(_deflate_to_temp, path, temp_dir) if raw else None)
+                        for arcname, path in deflated]
+
+        if raw_copy:
+            with open(source_zip, 'rb') as src_fp:
+                for arcname, path, info in raw_copy:
+                    zinfo = zipfile.ZipInfo(arcname, date_time=info.date_time)
+                    zinfo.compress_type = info.compress_type
+                    zinfo.external_attr = info.external_attr
+                    zinfo.CRC = info.CRC
+                    zinfo.compress_size = info.compress_size
+                    zinfo.file_size = info.file_size
+                    _write_raw_member(zf, zinfo, src_fp, _member_data_offset(src_fp, info))
+
+        for arcname, path in stored:
+            zf.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+
+        for arcname, path, future in deflate_jobs:
+            if future is None:
+                zf.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED)
+                continue
+            tmp_name, crc, compress_size = future.result()
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.CRC = crc
+                zinfo.compress_size = compress_size
+                with open(tmp_name, 'rb') as tmp:
+                    _write_raw_member(zf, zinfo, tmp, 0)
+            finally:
+                os.remove(tmp_name)
+    return archive_filename
 
 
 def md_frm_dataset_name(metadata, dataset_name):
@@ -82,24 +711,47 @@ def md_frm_dataset_name(metadata, dataset_name):
     return metadata
 
 
+SUMMARY_CORNERS = ('lefttop', 'righttop', 'rightbottom', 'leftbottom', 'lefttop')
+SUMMARY_TIME_FORMAT = '%Y%m%d %H:%M:%S.%f'
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_summary(summary_file, mtime_ns, size):
+    alos2md = {}
+    with open(summary_file, 'r') as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            key = key.strip()
+            if not sep or not key or key[0] in '#;':
+                continue
+            # same keys and values as the configparser based reader had: lowercase, no quotes
+            alos2md[key.replace('"', '').lower()] = value.strip().replace('"', '')
+
+    corners = [[float(alos2md['img_imagescene%slongitude' % c]), float(alos2md['img_imagescene%slatitude' % c])]
+               for c in SUMMARY_CORNERS]
+    return {
+        'alos2md': alos2md,
+        'corners': corners,
+        'starttime': datetime.datetime.strptime(alos2md['img_scenestartdatetime'], SUMMARY_TIME_FORMAT),
+        'endtime': datetime.datetime.strptime(alos2md['img_sceneenddatetime'], SUMMARY_TIME_FORMAT)
+    }
+
+
+def parse_summary(summary_file):
+    """
+    key=value pairs of a summary.txt with its typed scene corners (lon, lat) and start / end datetimes.
+    Memoized on the file's path, mtime and size; returns a copy that can be modified.
+    """
+    st = os.stat(summary_file)
+    return copy.deepcopy(_parse_summary(os.path.realpath(summary_file), st.st_mtime_ns, st.st_size))
+
+
 def md_frm_summary(summary_file, metadata):
     # open summary.txt to extract metadata
     # extract information from summary see: https://www.eorc.jaxa.jp/ALOS-2/en/doc/fdata/PALSAR-2_xx_Format_GeoTIFF_E_r.pdf
     logging.info("Extracting metadata from %s" % summary_file)
-    dummy_section = "summary"
-    with open(summary_file, 'r') as f:
-        # need to add dummy section for config parse to read .properties file
-        summary_string = '[%s]\n' % dummy_section + f.read()
-    summary_string = summary_string.replace('"', '')
-    buf = io.StringIO(summary_string)
-    config = configparser.ConfigParser()
-    config.readfp(buf)
-
-    # parse the metadata from summary.txt
-    alos2md = {}
-    for name, value in config.items(dummy_section):
-        alos2md[name] = value
-
+    summary = parse_summary(summary_file)
+    alos2md = summary['alos2md']
     metadata['alos2md'] = alos2md
 
     # others
@@ -108,29 +760,16 @@ def md_frm_summary(summary_file, metadata):
 
     location = {}
     location['type'] = 'Polygon'
-    location['coordinates'] = [[
-        [float(alos2md['img_imagescenelefttoplongitude']), float(alos2md['img_imagescenelefttoplatitude'])],
-        [float(alos2md['img_imagescenerighttoplongitude']), float(alos2md['img_imagescenerighttoplatitude'])],
-        [float(alos2md['img_imagescenerightbottomlongitude']), float(alos2md['img_imagescenerightbottomlatitude'])],
-        [float(alos2md['img_imagesceneleftbottomlongitude']), float(alos2md['img_imagesceneleftbottomlatitude'])],
-        [float(alos2md['img_imagescenelefttoplongitude']), float(alos2md['img_imagescenelefttoplatitude'])]
-        ]]
+    location['coordinates'] = [summary['corners']]
     metadata['location'] = location
-    metadata['starttime'] = datetime.datetime.strptime(alos2md['img_scenestartdatetime'], '%Y%m%d %H:%M:%S.%f').strftime("%Y-%m-%dT%H:%M:%S.%f")
-    metadata['endtime'] = datetime.datetime.strptime(alos2md['img_sceneenddatetime'], '%Y%m%d %H:%M:%S.%f').strftime("%Y-%m-%dT%H:%M:%S.%f")
+    metadata['starttime'] = summary['starttime'].strftime("%Y-%m-%dT%H:%M:%S.%f")
+    metadata['endtime'] = summary['endtime'].strftime("%Y-%m-%dT%H:%M:%S.%f")
     return metadata
 
 def md_frm_extractor(alos2_dir, metadata):
 
-    # extract metadata with isce from IMG files
-    md_file = "alos2_md.json"
-    cmd = "{}/scripts/extract_alos2_md.py --dir {} --output {}".format(
-        os.path.dirname(os.path.realpath(__file__)),
-        alos2_dir,
-        md_file)
-
-    check_call(cmd, shell=True)
-    md = json.load(open(md_file))
+    # extract metadata from bos, the CEOS leader or isce from IMG files
+    md = extract_alos2_md.extract_metadata(alos2_dir)
 
     metadata['alos2md'] = md
     metadata['dataset'] = "ALOS2-L1.1_SLC"
@@ -165,17 +804,24 @@ def create_metadata(alos2_dir, dataset_name):
     return metadata
 
 
-def create_dataset(metadata):
-    logging.info("Extracting datasets from metadata")
-    # get settings for dataset version
+def load_settings():
     settings_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                  'settings.json')
+    return json.load(open(settings_file))
+
 
-    settings = json.load(open(settings_file))
+def dataset_version(dataset_name):
+    """Version from settings.json that a product of dataset_name is made with"""
+    settings = load_settings()
+    return settings['ALOS2_SLC_VERSION'] if ALOS2_L11 in dataset_name else settings['ALOS2_GEOTIFF_VERSION']
+
+
+def create_dataset(metadata):
+    logging.info("Extracting datasets from metadata")
 
     # datasets.json
     # extract metadata for datasets
-    version = settings['ALOS2_SLC_VERSION'] if ALOS2_L11 in metadata['prod_name'] else settings['ALOS2_GEOTIFF_VERSION']
+    version = dataset_version(metadata['prod_name'])
     dataset = {
         'version': version,
         'label': metadata['prod_name'],
@@ -187,7 +833,13 @@ def create_dataset(metadata):
     return dataset
 
 def create_product_base(raw_dir, dataset_name):
-    metadata = create_metadata(raw_dir, dataset_name)
+    # metadata extraction can run ISCE, reuse it while the scene files are unchanged
+    cache = alos2_cache.MetadataCache()
+    key = alos2_cache.fingerprint(raw_dir, dataset_name)
+    metadata = cache.get(key)
+    if metadata is None:
+        metadata = create_metadata(raw_dir, dataset_name)
+        cache.put(key, metadata)
 
     # create dataset.json
     dataset = create_dataset(metadata)
@@ -213,6 +865,87 @@ def extract_dataset_name(raw_dir):
 
     return dataset_name
 
+def _scene_digits(ids, start, end):
+    digits = ids[:, start:end].astype(np.int64) - ord('0')
+    return (digits * 10 ** np.arange(end - start - 1, -1, -1)).sum(axis=1)
+
+def _scene_chars(ids, start, end):
+    return np.ascontiguousarray(ids[:, start:end]).view('U%d' % (end - start)).ravel()
+
+def decode_scene_names(names):
+    """
+    Decode many ALOS2 scene names at once. Each name may be a product name, an IMG file name or
+    any string holding a scene ID (ALOS2011482800-140609), with or without the product suffix.
+    Returns a dict of numpy columns: name, valid, orbit, frame, track, date, mode, look, level and direction.
+    Fields that a name does not carry are 0, NaT or ''.
+    """
+    names = np.asarray(names, dtype=str).ravel()
+    n = len(names)
+    width = max(names.dtype.itemsize // 4, 1)
+
+    # code points of every name, padded so a full product name can be gathered from any offset
+    chars = np.zeros((n, width + SCENE_NAME_LEN), dtype=np.uint32)
+    if n:
+        chars[:, :width] = names.astype('U%d' % width).view(np.uint32).reshape(n, width)
+    start = np.char.find(names, 'ALOS2')
+    ids = np.take_along_axis(chars, np.maximum(start, 0)[:, None] + np.arange(SCENE_NAME_LEN), axis=1)
+
+    is_digit = (ids >= ord('0')) & (ids <= ord('9'))
+    valid = (start >= 0) & is_digit[:, 5:14].all(axis=1) & is_digit[:, 15:21].all(axis=1) & \
+            (ids[:, 14] == ord('-'))
+    look = _scene_chars(ids, 25, 26)
+    direction = _scene_chars(ids, 31, 32)
+    full = valid & (ids[:, 21] == ord('-')) & np.isin(look, ['L', 'R']) & np.isin(direction, ['A', 'D'])
+
+    orbit = np.where(valid, _scene_digits(ids, 5, 10), 0)
+    frame = np.where(valid, _scene_digits(ids, 10, 14), 0)
+    # same empirical orbit to path number formula as md_frm_dataset_name
+    track = np.where(valid, (14 * orbit + 24) % 207, 0)
+
+    yymmdd = _scene_digits(ids, 15, 21)
+    month = yymmdd // 100 % 100
+    day = yymmdd % 100
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    year_month = np.where(valid, yymmdd // 10000 + 30, 0).astype('datetime64[Y]').astype('datetime64[M]') + \
+                 np.where(valid, month - 1, 0).astype('timedelta64[M]')
+    date = year_month.astype('datetime64[D]') + np.where(valid, day - 1, 0).astype('timedelta64[D]')
+    # days past the end of their month (e.g. 31 Feb) roll over into the next one, they are not dates
+    valid &= date.astype('datetime64[M]') == year_month
+    date[~valid] = np.datetime64('NaT')
+    full &= valid
+
+    return {
+        'name': names,
+        'valid': valid,
+        'orbit': orbit,
+        'frame': frame,
+        'track': track,
+        'date': date,
+        'mode': np.where(full, _scene_chars(ids, 22, 25), ''),
+        'look': np.where(full, look, ''),
+        'level': np.where(full, _scene_chars(ids, 26, 29), ''),
+        'direction': np.where(full, direction, '')
+    }
+
+def filter_scene_names(names, tracks=None, frames=None, levels=None, modes=None, keep_invalid=False):
+    """
+    Boolean mask of the names whose decoded scene matches every given filter (a list of accepted values,
+    None accepts anything). Names that cannot be decoded are kept only with keep_invalid.
+    """
+    scenes = decode_scene_names(names)
+    mask = scenes['valid'].copy()
+    if tracks:
+        mask &= np.isin(scenes['track'], [int(t) for t in tracks])
+    if frames:
+        mask &= np.isin(scenes['frame'], [int(f) for f in frames])
+    if levels:
+        mask &= np.isin(scenes['level'], [str(l).lstrip('L') for l in levels])
+    if modes:
+        mask &= np.isin(scenes['mode'], list(modes))
+    if keep_invalid:
+        mask |= ~scenes['valid']
+    return mask
+
 # def check_path_num(metadata, path_number):
 #     if path_number:
 #         path_num = int(float(path_number))
@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
 import re
+import json
+import time
 import subprocess as sp
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest_alos2_md import check_datasets
+from alos2_utils import filter_scene_names
+import scene_index
+
+IMG_REGEX = re.compile(r"IMG-[A-Z]{2}-ALOS2.{05}(.{04}-\d{6})-.{4}1.1.*")
+DATASET_REGEX = re.compile(r"IMG-[A-Z]{2}-(ALOS2.{27}).*")
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.alos2_ingest', 'gekko_scan_index.json')
+SCAN_WORKERS = 32
+
 def cmdLineParse():
     '''
     Command line parser.
@@ -16,8 +32,120 @@ def cmdLineParse():
             help = 'regular expression to match folder structure where ALOS2 data is stored. Leave "" for none')
     parser.add_argument('-pbs', dest='pbsfile', type=str, default='',
             help = 'pbsfile to do ingestion')
+    parser.add_argument('-grq_es_url', dest='grq_es_url', type=str, default='',
+            help = 'GRQ ES url to check for already ingested scenes before submitting. If not specified, submits everything')
+    parser.add_argument('-njobs', dest='njobs', type=int, default=0,
+            help = 'pack the scenes into this many PBS jobs, each working through a manifest. 0 submits one job per scene')
+    parser.add_argument('-ncpus', dest='ncpus', type=int, default=24,
+            help = 'cpus requested by each packed job, scenes are processed one per cpu')
+    parser.add_argument('-manifest_dir', dest='manifest_dir', type=str, default='./manifests',
+            help = 'directory to write the manifests of packed jobs to, in a subdirectory per run')
+    parser.add_argument('-index', dest='index', type=str, default=DEFAULT_INDEX,
+            help = 'scan index of directory mtimes, unchanged directories are not listed again on later runs')
+    parser.add_argument('-rescan', dest='rescan', action='store_true',
+            help = 'ignore the scan index for this run: list every directory and resubmit every scene. The index is kept and updated')
+    parser.add_argument('-scan_workers', dest='scan_workers', type=int, default=SCAN_WORKERS,
+            help = 'threads listing directories in parallel')
+    parser.add_argument('-track', dest='tracks', type=int, nargs='+', default=None,
+            help = 'only submit scenes of these path (track) numbers')
+    parser.add_argument('-frame', dest='frames', type=int, nargs='+', default=None,
+            help = 'only submit scenes of these frame numbers')
+    parser.add_argument('-mode', dest='modes', type=str, nargs='+', default=None,
+            help = 'only submit scenes of these acquisition modes, e.g. UBS FBD')
+    parser.add_argument('-output', dest='output', type=str, default='',
+            help = 'write the "dir fdate" manifest of the frame dates to submit to this file')
     return parser.parse_args()
 
+def load_index(index_file):
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return {"dirs": {}, "submitted": []}
+
+def save_index(index, index_file):
+    if os.path.dirname(index_file) and not os.path.isdir(os.path.dirname(index_file)):
+        os.makedirs(os.path.dirname(index_file))
+    tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+
+def record_submitted(index, dataset_names, index_file):
+    """Add dataset_names to the submitted history and save the index right away"""
+    index["submitted"] = sorted(set(index["submitted"]).union(dataset_names))
+    save_index(index, index_file)
+
+def scan_dir(path, cached):
+    """List a directory unless its mtime matches the cached entry. Returns (entry, listed)"""
+    mtime = os.stat(path).st_mtime_ns
+    if cached and cached["mtime"] == mtime:
+        return cached, False
+
+    subdirs = []
+    imgs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.startswith('IMG'):
+                imgs.append(entry.name)
+
+    scenes = []
+    fdates = sorted(set(m.group(1) for m in map(IMG_REGEX.match, imgs) if m))
+    for fdate in fdates:
+        # same dataset name ingest_alos2_md.py will create for this frame date
+        img_file = sorted(x for x in imgs if fdate in x)[0]
+        scenes.append([fdate, DATASET_REGEX.match(img_file).group(1) + "-md"])
+    return {"mtime": mtime, "subdirs": subdirs, "scenes": scenes}, True
+
+def scan(top, dirs, workers=SCAN_WORKERS):
+    """
+    Walk top with a pool of threads, one os.scandir per directory. A directory whose mtime
+    is unchanged since the last run is not listed again, its subdirectories are still visited
+    as changes deeper down do not touch its mtime. Returns the new {dir: entry} index.
+    """
+    scanned = {}
+    listed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_dir, top, dirs.get(top)): top}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    entry, was_listed = future.result()
+                except OSError as e:
+                    print("Unable to scan {}: {}".format(path, e))
+                    continue
+                scanned[path] = entry
+                listed += was_listed
+                for subdir in entry["subdirs"]:
+                    pending[executor.submit(scan_dir, subdir, dirs.get(subdir))] = subdir
+    print("Scanned {} directories, {} of them changed since the last scan".format(len(scanned), listed))
+    return scanned
+
+def submit_packed(jobs, args, index):
+    """
+    Spread the scenes round-robin over args.njobs manifests and submit one PBS job per manifest.
+    Each run writes its manifests to a directory of its own, so jobs still queued from an
+    earlier run keep their manifests. The scenes of each manifest are recorded as submitted
+    in the index as soon as its qsub succeeds.
+    """
+    if not jobs:
+        return
+    run_id = "{}_{}".format(time.strftime("%Y%m%d%H%M%S"), os.getpid())
+    run_dir = os.path.abspath(os.path.join(args.manifest_dir, run_id))
+    os.makedirs(run_dir)
+    njobs = min(args.njobs, len(jobs))
+    for i in range(njobs):
+        manifest = os.path.join(run_dir, "manifest_{:04d}.txt".format(i))
+        with open(manifest, "x") as f:
+            for root, fdate, dataset_name in jobs[i::njobs]:
+                f.write("{} {}\n".format(os.path.abspath(root), fdate))
+        print("submitting job for manifest:{} with {} scenes".format(manifest, len(jobs[i::njobs])))
+        sp.check_call("qsub -v manifest={} -l select=1:ncpus={} -N alos2_md_{}_{:04d} {}".format(
+            manifest, args.ncpus, run_id, i, args.pbsfile), shell=True)
+        record_submitted(index, [dataset_name for _, _, dataset_name in jobs[i::njobs]], args.index)
 
 if __name__ == "__main__":
     args = cmdLineParse()
@@ -28,27 +156,59 @@ if __name__ == "__main__":
     else:
         regex = args.regex
 
-    for root, subFolders, files in os.walk(args.dir):
-        if files:
-            fdates=[]
-            for x in files:
-                m = re.search("IMG-[A-Z]{2}-ALOS2.{05}(.{04}-\d{6})-.{4}1.1.*", x)
-                if m:
-                    fdates.append(m.group(1))
+    index = load_index(args.index)
+    top = os.path.abspath(args.dir)
+    # -rescan lists every directory again, the index is still updated with what it finds
+    scanned = scan(top, {} if args.rescan else index["dirs"], args.scan_workers)
+    # keep the entries of other trees scanned with the same index
+    index["dirs"] = dict((d, e) for d, e in index["dirs"].items()
+                         if d != top and not d.startswith(top.rstrip(os.sep) + os.sep))
+    index["dirs"].update(scanned)
+    save_index(index, args.index)
 
-            fdates_unique = set(fdates)
-            fdates_unique = list(fdates_unique)
-            print("Frame Dates: {}".format(fdates_unique))
+    submitted = set(index["submitted"])
+    # -rescan resubmits everything, the history of submitted scenes is kept
+    previously_submitted = set() if args.rescan else submitted
+    folder_regex = re.compile(regex)
+    jobs = []
+    for root in sorted(scanned):
+        if scanned[root]["scenes"] and folder_regex.search(root):
+            for fdate, dataset_name in scanned[root]["scenes"]:
+                if dataset_name not in previously_submitted:
+                    jobs.append((root, fdate, dataset_name))
+    print("Found {} frame dates not submitted before".format(len(jobs)))
 
-            for fdate in fdates_unique:
-                folder_struct = re.search(regex, root)
+    if jobs and (args.tracks or args.frames or args.modes):
+        keep = filter_scene_names([dataset_name for _, _, dataset_name in jobs],
+                                  tracks=args.tracks, frames=args.frames, modes=args.modes)
+        jobs = [j for j, k in zip(jobs, keep) if k]
+        print("{} frame dates match the track / frame / mode filters".format(len(jobs)))
 
-                if folder_struct:
-                    print("submitting job for root:{} frame_date:{}".format(root,fdate))
-                    sp.check_call("qsub -v dir={},fdate={} -N {} {}".format(root,fdate,fdate,args.pbsfile),shell=True)
+    scenes_db = scene_index.open_index()
+    if scenes_db:
+        indexed = scenes_db.existing(dataset_name for _, _, dataset_name in jobs)
+        scenes_db.close()
+        print("Skipping {} frame dates already in the local scene index".format(len(indexed)))
+        jobs = [j for j in jobs if j[2] not in indexed]
 
+    if args.grq_es_url:
+        # one bulk lookup instead of every PBS job checking for its own scene
+        existing = check_datasets(args.grq_es_url, [dataset_name for _, _, dataset_name in jobs])
+        print("Skipping {} frame dates already in GRQ".format(len([j for j in jobs if j[2] in existing])))
+        jobs = [j for j in jobs if j[2] not in existing]
 
-        # ignore root and subFolders
-        # get all of the files that resembles IMG file regex,
-        # get a unique set of their dates
-        # submit to qsub with path name
+    if args.output:
+        with open(args.output, "w") as f:
+            for root, fdate, dataset_name in jobs:
+                f.write("{} {}\n".format(os.path.abspath(root), fdate))
+
+    if not args.pbsfile:
+        sys.exit(0)
+
+    if args.njobs > 0:
+        submit_packed(jobs, args, index)
+    else:
+        for root, fdate, dataset_name in jobs:
+            print("submitting job for root:{} frame_date:{}".format(root,fdate))
+            sp.check_call("qsub -v dir={},fdate={} -N {} {}".format(root,fdate,fdate,args.pbsfile),shell=True)
+            record_submitted(index, [dataset_name], args.index)
@@ -8,6 +8,7 @@ Ingest ALOS2 METADATA into ARIA-SG-NTU GRQ from ALOS2 raw data (extracted zip fi
 
 """
 import alos2_utils
+import scene_index
 import logging
 import glob
 import os
@@ -18,10 +19,14 @@ import subprocess as sp
 import time
 import shutil
 import requests
+import concurrent.futures
 
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
 logging.basicConfig(format=log_format, level=logging.INFO)
 
+# dataset IDs per GRQ query in dataset_versions / check_datasets
+GRQ_CHUNK_SIZE = 1000
+
 def cmdLineParse():
     '''
     Command line parser.
@@ -40,8 +45,83 @@ def cmdLineParse():
                         help='directory of hysds repo where ingest_dataset.py is kept')
     parser.add_argument('-grq_es_url', dest='grq_es_url', type=str, default='',
                         help='Specify GRQ ES url to ingest ALOS-2 metadata to. If not specified, will look into celeryconfig.py in hysdsdir')
+    parser.add_argument('-manifest', dest='manifest', type=str, default='',
+                        help='file with one "dir fdate" per line, to ingest many scenes in one job instead of -dir / -fdate')
+    parser.add_argument('-workers', dest='workers', type=int, default=0,
+                        help='scenes of the manifest processed in parallel. Defaults to $NCPUS, or the number of cores')
     return parser.parse_args()
 
+def _search_url(es_url, es_index):
+    # es_url is bytes when read from celeryconfig with check_output
+    if isinstance(es_url, bytes):
+        es_url = es_url.decode("utf-8")
+    es_url = es_url.strip()
+    if es_url.endswith("/"):
+        return '%s%s/_search' % (es_url, es_index)
+    else:
+        return '%s/%s/_search' % (es_url, es_index)
+
+def dataset_versions(es_url, ids, es_index="grq", chunk_size=GRQ_CHUNK_SIZE):
+    """Query for many dataset IDs at once. Returns the version of each ID that exists, as id -> version."""
+    ids = sorted(set(ids))
+    search_url = _search_url(es_url, es_index)
+    found = {}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        query = {
+            "query": {"ids": {"values": chunk}},
+            "_source": ["version"],
+            "size": len(chunk),
+        }
+        r = requests.post(search_url, data=json.dumps(query))
+        if r.status_code == 200:
+            found.update((hit['_id'], hit.get('_source', {}).get('version')) for hit in r.json()['hits']['hits'])
+        elif r.status_code == 404:
+            logging.info("%s not found, assuming no datasets exist yet" % search_url)
+        else:
+            logging.error("Failed to query %s:\n%s" % (es_url, r.text))
+            r.raise_for_status()
+    logging.info("%s of %s datasets already in GRQ" % (len(found), len(ids)))
+    return found
+
+def check_datasets(es_url, ids, es_index="grq", chunk_size=GRQ_CHUNK_SIZE):
+    """Query for many dataset IDs at once. Returns the set of IDs that exist."""
+    return set(dataset_versions(es_url, ids, es_index, chunk_size))
+
+def grq_es_url():
+    """GRQ ES url from $GRQ_ES_URL, else from the HySDS celery config of the worker, else None"""
+    if os.environ.get('GRQ_ES_URL'):
+        return os.environ['GRQ_ES_URL']
+    try:
+        from hysds.celery import app
+        return app.conf['GRQ_ES_URL']
+    except Exception as e:
+        logging.warning("Unable to get the GRQ ES url from the HySDS config: %s" % e)
+        return None
+
+def produced_versions(ids, es_url=None):
+    """
+    Dataset version of each of ids that was already produced, as id -> version. The local scene index
+    is a fast path when one is configured, GRQ is asked for the rest. A failed GRQ lookup is logged and
+    its IDs are treated as not produced.
+    """
+    ids = set(ids)
+    found = {}
+    index = scene_index.open_index()
+    if index:
+        try:
+            found.update(index.versions(ids))
+        finally:
+            index.close()
+    rest = ids - set(found)
+    es_url = es_url or (grq_es_url() if rest else None)
+    if rest and es_url:
+        try:
+            found.update(dataset_versions(es_url, rest))
+        except requests.exceptions.RequestException as e:
+            logging.warning("Unable to look up %s datasets in GRQ: %s" % (len(rest), e))
+    return found
+
 def check_dataset(es_url, id, es_index="grq"):
     """Query for dataset with specified input ID."""
 
@@ -56,10 +136,7 @@ def check_dataset(es_url, id, es_index="grq"):
         "fields": [],
     }
 
-    if es_url.endswith("/".encode('utf-8')):
-        search_url = '%s%s/_search' % (es_url.decode("utf-8"), es_index)
-    else:
-        search_url = '%s/%s/_search' % (es_url.decode("utf-8"), es_index)
+    search_url = _search_url(es_url, es_index)
     r = requests.post(search_url, data=json.dumps(query))
     if r.status_code == 200:
         result = r.json()
@@ -74,19 +151,13 @@ def check_dataset(es_url, id, es_index="grq"):
         else: r.raise_for_status()
     return total, id
 
-if __name__ == "__main__":
-    args = cmdLineParse()
-
-    if args.grq_es_url:
-        grq_es_url = args.grq_es_url
-    else:
-        # if not specidied, run app.conf
-        grq_es_url = sp.check_output('/home/stchin/venv2/bin/python -c "from hysds.celery import app; print app.conf[\'GRQ_ES_URL\']"',
-                                     shell=True)
-
+def ingest_scene(scene_dir, fdate, args, grq_es_url):
+    """Create and ingest the metadata of the frame date fdate stored in scene_dir"""
+    cwd = os.getcwd()
+    index = None
     try:
-        data_files = sorted(glob.glob(os.path.join(args.dir, '*{}*'.format(args.fdate))))
-        temp_dir = "tmp_{}_{}".format(args.fdate,time.time())
+        data_files = sorted(glob.glob(os.path.join(scene_dir, '*{}*'.format(fdate))))
+        temp_dir = "tmp_{}_{}".format(fdate,time.time())
         os.makedirs(temp_dir)
         for f in data_files:
             os.symlink(f, os.path.join(temp_dir, os.path.basename(f)))
@@ -95,13 +166,18 @@ if __name__ == "__main__":
         raw_dir = "."
         dataset_name = alos2_utils.extract_dataset_name(raw_dir) + "-md"
 
-        total, id = check_dataset(grq_es_url, dataset_name)
-        logging.info("In GRQ - id: {} total: {}.".format(id, total))
+        index = scene_index.open_index()
+        if index and index.has_scene(dataset_name):
+            total, id = 1, dataset_name
+            logging.info("{} is in the local scene index.".format(dataset_name))
+        else:
+            total, id = check_dataset(grq_es_url, dataset_name)
+            logging.info("In GRQ - id: {} total: {}.".format(id, total))
 
         if total > 0:
             logging.info("Not ingesting {} as it is present in GRQ as {}.".format(dataset_name, id))
             logging.info("Cleaning up {} directory.".format(temp_dir))
-            os.chdir("..")
+            os.chdir(cwd)
             shutil.rmtree(temp_dir)
         else:
             logging.info("Creating metadata for {}.".format(dataset_name))
@@ -122,21 +198,70 @@ if __name__ == "__main__":
                 json.dump(dataset, f, indent=2)
                 f.close()
 
-            os.chdir("..")
+            os.chdir(cwd)
             #ingest
             ingest_script = os.path.join(args.hysds_dir, "scripts/ingest_dataset.py")
             logging.info("Ingesting {} into ARIA.".format(proddir))
             sp.check_call("/home/stchin/venv2/bin/python {} {}/{} {}".format(ingest_script,temp_dir,proddir, args.ds_file), shell=True)
 
+            if index:
+                try:
+                    index.add(metadata, dataset)
+                except Exception as e:
+                    logging.warning("Unable to add {} to the scene index: {}".format(dataset_name, e))
+
             #cleanup
             logging.info("Ingestion of {} complete. Cleaning up {} directory.".format(proddir,temp_dir))
             shutil.rmtree(temp_dir)
 
     except Exception as e:
-        logging.warning("Ingestion of {} with frame_date:{} might have failed. Check ARIA!".format(args.dir,args.fdate))
-        with open('_alt_error.txt', 'a') as f:
+        logging.warning("Ingestion of {} with frame_date:{} might have failed. Check ARIA!".format(scene_dir,fdate))
+        with open(os.path.join(cwd, '_alt_error.txt'), 'a') as f:
             f.write("%s\n" % str(e))
-        with open('_alt_traceback.txt', 'a') as f:
+        with open(os.path.join(cwd, '_alt_traceback.txt'), 'a') as f:
             f.write("%s\n" % traceback.format_exc())
         raise
+    finally:
+        os.chdir(cwd)
+        if index:
+            index.close()
+
+def read_manifest(manifest):
+    """(dir, fdate) pairs from a manifest file with one "dir fdate" per line"""
+    scenes = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                scene_dir, fdate = line.rsplit(None, 1)
+                scenes.append((scene_dir, fdate))
+    return scenes
+
+if __name__ == "__main__":
+    args = cmdLineParse()
 
+    if args.grq_es_url:
+        grq_es_url = args.grq_es_url
+    else:
+        # if not specidied, run app.conf
+        grq_es_url = sp.check_output('/home/stchin/venv2/bin/python -c "from hysds.celery import app; print app.conf[\'GRQ_ES_URL\']"',
+                                     shell=True)
+
+    if not args.manifest:
+        ingest_scene(args.dir, args.fdate, args, grq_es_url)
+    else:
+        # many scenes in one job, one scene per core
+        scenes = read_manifest(args.manifest)
+        workers = args.workers or int(os.environ.get('NCPUS', 0)) or os.cpu_count()
+        logging.info("Ingesting {} scenes from {} with {} workers.".format(len(scenes), args.manifest, workers))
+        failed = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(ingest_scene, scene_dir, fdate, args, grq_es_url), (scene_dir, fdate))
+                           for scene_dir, fdate in scenes)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+        if failed:
+            raise RuntimeError("Ingestion of {} of {} scenes might have failed: {}".format(len(failed), len(scenes), failed))
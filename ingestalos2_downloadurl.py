@@ -25,6 +25,8 @@ def cmdLineParse():
     parser = argparse.ArgumentParser( description='Getting ALOS-2 L2.1 / L1.1 data into ARIA')
     parser.add_argument('-d', dest='download_url', type=str, default='',
             help = 'Download url if available')
+    parser.add_argument('-s', dest='stream_extract', action='store_true', default=False,
+            help = 'Extract the zip while it is downloading')
 
     return parser.parse_args()
 
@@ -38,11 +40,16 @@ if __name__ == "__main__":
             # no inputs defined (as per defaults)
             # we need to try to load from context
             args.download_url = ctx["download_url"]
+        stream_extract = args.stream_extract or str(ctx.get("stream_extract", False)).lower() == "true"
 
-        # TODO: remember to bring back the download
-        alos2_utils.download(args.download_url)
         download_source = args.download_url
-        alos2_productize.ingest_alos2(download_source)
+        if stream_extract:
+            unzip_dir = alos2_utils.download_and_extract(args.download_url)
+            alos2_productize.ingest_alos2(download_source, unzip_dirs=[unzip_dir])
+        else:
+            # TODO: remember to bring back the download
+            alos2_utils.download(args.download_url)
+            alos2_productize.ingest_alos2(download_source)
 
     except Exception as e:
         with open('_alt_error.txt', 'a') as f:
@@ -10,15 +10,16 @@ Ingest ALOS2 data from a source to a destination:
 HTTP/HTTPS, FTP and OAuth authentication is handled using .netrc.
 """
 
-import logging, traceback, argparse, os, json
+import logging, traceback, argparse, json
 import alos2_productize
 import scripts.sentinelasia_download as sa
-import subprocess as sp
+from scripts.sentinelasia_catalog import EORCatalog, DEFAULT_CATALOG, REFRESH_DAYS
+import submit_job
+from ingestalos2_sentinelasia import preflight
 from datetime import datetime
 
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
 logging.basicConfig(format=log_format, level=logging.INFO)
-PGE_PATH = os.path.dirname(__file__)
 
 def cmdLineParse():
     '''
@@ -32,6 +33,8 @@ def cmdLineParse():
     parser.add_argument('-u','--username', action="store", dest="username", help='Sentinel Asia Login, if not givem, checks .netrc')
     parser.add_argument('-p','--password', action="store", dest="password", help='Sentinel Asia Login, if not givem, checks .netrc')
     parser.add_argument('-dry_run', action='store_true', dest="dry_run", default=False, help='Will not downlaod files if flag is defined')
+    parser.add_argument('-catalog', action="store", dest="catalog", default=DEFAULT_CATALOG, help='SQLite catalog of crawled EORs and submitted data IDs, defaults to %s' % DEFAULT_CATALOG)
+    parser.add_argument('-refresh_days', action="store", dest="refresh_days", type=int, default=REFRESH_DAYS, help='Unchanged EORs observed within this many days are still re-crawled for new data, defaults to %s' % REFRESH_DAYS)
     return parser.parse_args()
 
 def submit_sa_data_download(data_id, queue, job_type):
@@ -89,25 +92,34 @@ if __name__ == "__main__":
         # Remove all need for eor and data id
         args.eor_id = ""
         args.data_id = ""
-        download_params = sa.get_all_params(args)
+        catalog = EORCatalog(args.catalog, refresh_days=args.refresh_days)
+        sa.get_all_params(args, catalog)
+        # submit everything not submitted yet, including leftovers from earlier runs
+        download_params = catalog.pending()
+        print("{} data IDs have not been submitted yet".format(len(download_params)))
+        # files we would not ingest stay pending, in case the include rules change
+        download_params, dropped = preflight(download_params)
+        print("{} data IDs pass the preflight checks".format(len(download_params)))
 
         if not args.dry_run:
             # for loop download split into 1 download = 1 job if only eor_id is specified
+            queue = "aria-job_worker-large"
+            tag = args.tag
+            job_type = "job-ingest_alos2_sentinelasia"
+            job_spec = "{}:{}".format(job_type, tag)
+            jobs = []
             for param in download_params:
                 data_id = param["download_url"].rsplit('=', 1)[-1]
-                queue = "aria-job_worker-large"
-                tag = args.tag
-                job_type = "job-ingest_alos2_sentinelasia"
-                job_spec = "{}:{}".format(job_type, tag)
-                rtime = datetime.utcnow()
-                job_name = "%s-%s-%s" % (job_spec, data_id, rtime.strftime("%d_%b_%Y_%H:%M:%S"))
                 rule, params = submit_sa_data_download(data_id, queue, job_type)
-    
-                command = PGE_PATH + '/submit_job.py --job_name %s --job_spec %s --params \'%s\' --rule \'%s\'' \
-                          % (job_name, job_spec, json.dumps(params), json.dumps(rule))
-
-                print("submitting job: "+ command)
-                sp.check_call(command, shell=True)
+                jobs.append((data_id, params, rule))
+
+            submitted, failed = submit_job.submit_jobs(job_spec, jobs)
+            for data_id, job_name in submitted.items():
+                catalog.mark_submitted(data_id, job_name)
+            if failed:
+                raise RuntimeError("Failed to submit {} of {} jobs: {}".format(
+                    len(failed), len(jobs), json.dumps(failed, indent=2)))
+        catalog.close()
 
 
     except Exception as e:
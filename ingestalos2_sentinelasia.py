@@ -10,15 +10,16 @@ Ingest ALOS2 data from a source to a destination:
 HTTP/HTTPS, FTP and OAuth authentication is handled using .netrc.
 """
 
-import logging, traceback, argparse, os, json
+import logging, traceback, argparse, json
 import alos2_productize
+import alos2_utils
+import ingest_alos2_md
 import scripts.sentinelasia_download as sa
-import subprocess as sp
+import submit_job
 from datetime import datetime
 
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
 logging.basicConfig(format=log_format, level=logging.INFO)
-PGE_PATH = os.path.dirname(__file__)
 
 def cmdLineParse():
     '''
@@ -82,6 +83,65 @@ def submit_sa_data_download(data_id, queue, job_type):
     return rule, params
 
 
+def preflight(download_params, rules=None, es_url=None):
+    """
+    Split download_params into the files worth downloading and {data_id: reason} for the rest, before
+    anything is transferred. The scene is decoded from the filename or the EOR's filetitle and checked
+    against the SENTINELASIA_INCLUDE rules of settings.json (levels / modes / tracks / frames, empty
+    accepts all), then products already made at the current dataset version are dropped: the scene
+    index is asked first if one is configured, GRQ (es_url, else see grq_es_url) for the rest.
+    Zips with no decodable scene are kept.
+    """
+    if rules is None:
+        rules = alos2_utils.load_settings().get("SENTINELASIA_INCLUDE", {})
+    filenames = alos2_utils.decode_scene_names([p["filename"] for p in download_params])
+    titles = alos2_utils.decode_scene_names([p.get("filetitle", "") for p in download_params])
+    levels = [str(l).lstrip('L') for l in rules.get("levels") or []]
+
+    candidates = []
+    dropped = {}
+    for i, param in enumerate(download_params):
+        # the filename if it carries the product level, else the title, else whichever holds a scene ID
+        scene = filenames if filenames['level'][i] or not titles['level'][i] and filenames['valid'][i] else titles
+        level = scene['level'][i]
+        # with a level the name holds a full product name, the dataset ID of its product
+        name = str(scene['name'][i])
+        product = name[name.find('ALOS2'):][:alos2_utils.SCENE_NAME_LEN] if level else None
+
+        if ".zip" not in param["filename"]:
+            reason = "file is not in zipped format"
+        elif not scene['valid'][i]:
+            reason = None
+        elif level and levels and level not in levels:
+            reason = "level {} is not included".format(level)
+        elif scene['mode'][i] and rules.get("modes") and scene['mode'][i] not in rules["modes"]:
+            reason = "mode {} is not included".format(scene['mode'][i])
+        elif rules.get("tracks") and scene['track'][i] not in rules["tracks"]:
+            reason = "track {} is not included".format(scene['track'][i])
+        elif rules.get("frames") and scene['frame'][i] not in rules["frames"]:
+            reason = "frame {} is not included".format(scene['frame'][i])
+        else:
+            reason = None
+
+        if reason:
+            print("Not downloading {} ({}): {}".format(param["data_id"], param["filename"], reason))
+            dropped[param["data_id"]] = reason
+        else:
+            candidates.append((param, product))
+
+    # one bulk lookup for every product that passed the rules
+    produced = ingest_alos2_md.produced_versions([product for _, product in candidates if product], es_url)
+    keep = []
+    for param, product in candidates:
+        if product in produced and produced[product] == alos2_utils.dataset_version(product):
+            reason = "{} {} was already produced".format(product, produced[product])
+            print("Not downloading {} ({}): {}".format(param["data_id"], param["filename"], reason))
+            dropped[param["data_id"]] = reason
+        else:
+            keep.append(param)
+    return keep, dropped
+
+
 if __name__ == "__main__":
     args = cmdLineParse()
 
@@ -100,6 +160,9 @@ if __name__ == "__main__":
             download_params = sa.get_all_params(args)
 
 
+        # drop what we would not ingest before transferring anything
+        keep_params, dropped = preflight(download_params)
+
         if args.data_id:
             # only 1 download if only data_id is specified
             # check if the file is something we can ingest before downloading
@@ -110,8 +173,10 @@ if __name__ == "__main__":
             if ".zip" not in download_params[0]["filename"]:
                 raise RuntimeError("We are unable tp process data_id: {}. File is not in zipped format ({}/{}B)."
                                    .format(args.data_id,filename,filesize))
+            elif args.data_id in dropped:
+                print("Skipping data_id: {}, {}".format(args.data_id, dropped[args.data_id]))
             else:
-                print("Download url {} passed zip test".format(url))
+                print("Download url {} passed preflight checks".format(url))
                 # TODO remember to make me download again
                 sa.do_download(args, download_params)
                 download_source = url
@@ -119,21 +184,20 @@ if __name__ == "__main__":
 
         else:
             # for loop download split into 1 download = 1 job if only eor_id is specified
-            for param in download_params:
+            queue = ctx["queue"]
+            tag = ctx['job_specification']['job-version']
+            job_type = "job-ingest_alos2_sentinelasia"
+            job_spec = "{}:{}".format(job_type, tag)
+            jobs = []
+            for param in keep_params:
                 data_id = param["download_url"].rsplit('=', 1)[-1]
-                queue = ctx["queue"]
-                tag = ctx['job_specification']['job-version']
-                job_type = "job-ingest_alos2_sentinelasia"
-                job_spec = "{}:{}".format(job_type, tag)
-                rtime = datetime.utcnow()
-                job_name = "%s-%s-%s" % (job_spec, data_id, rtime.strftime("%d_%b_%Y_%H:%M:%S"))
                 rule, params = submit_sa_data_download(data_id, queue, job_type)
+                jobs.append((data_id, params, rule))
 
-                command = PGE_PATH + '/submit_job.py --job_name %s --job_spec %s --params \'%s\' --rule \'%s\'' \
-                          % (job_name, job_spec, json.dumps(params), json.dumps(rule))
-
-                print("submitting job: "+ command)
-                sp.check_call(command, shell=True)
+            submitted, failed = submit_job.submit_jobs(job_spec, jobs)
+            if failed:
+                raise RuntimeError("Failed to submit {} of {} jobs: {}".format(
+                    len(failed), len(jobs), json.dumps(failed, indent=2)))
 
 
     except Exception as e:
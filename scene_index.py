@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Local index of the ALOS2 scenes this package produced, built from their met.json / dataset.json,
+so jobs can skip scenes that were already ingested and look up what covers an area or a date range
+without asking GRQ. Scenes are kept in SQLite, with their footprint bounding boxes in an R-tree.
+
+The index is off unless $ALOS2_SCENE_INDEX names its database. SQLite locking is not reliable
+on NFS / Lustre, so the database must be on a filesystem local to the host writing it, and only
+processes on that one host may write to it; e.g. on gekko, PBS jobs on the compute nodes must
+not share a database in $HOME.
+"""
+
+import os
+import json
+import glob
+import logging
+import argparse
+import sqlite3
+from datetime import datetime
+
+# ids per IN (...) query, below SQLite's bound parameter limit
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    pk INTEGER PRIMARY KEY,
+    id TEXT UNIQUE,
+    scene_id TEXT,
+    dataset TEXT,
+    track INTEGER,
+    frame INTEGER,
+    level TEXT,
+    starttime TEXT,
+    endtime TEXT,
+    location TEXT,
+    met_file TEXT,
+    indexed_at TEXT,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_scene_id ON scenes (scene_id);
+CREATE INDEX IF NOT EXISTS scenes_track_frame ON scenes (track, frame);
+CREATE INDEX IF NOT EXISTS scenes_time ON scenes (starttime, endtime);
+CREATE VIRTUAL TABLE IF NOT EXISTS scenes_bbox USING rtree (pk, min_lon, max_lon, min_lat, max_lat);
+"""
+
+COLUMNS = ('id', 'scene_id', 'dataset', 'track', 'frame', 'level', 'starttime', 'endtime', 'location', 'met_file',
+           'version')
+
+
+def default_path():
+    """Index location from $ALOS2_SCENE_INDEX, the index is off if it is unset or empty"""
+    return os.environ.get('ALOS2_SCENE_INDEX', '')
+
+
+def open_index():
+    """The default SceneIndex, or None if it is turned off or cannot be opened"""
+    path = default_path()
+    if not path:
+        return None
+    try:
+        return SceneIndex(path)
+    except (OSError, sqlite3.Error) as e:
+        logging.warning("Unable to open scene index %s: %s" % (path, e))
+        return None
+
+
+def _bbox(location):
+    """(min_lon, max_lon, min_lat, max_lat) of a GeoJSON geometry"""
+    points = []
+
+    def walk(coords):
+        if coords and isinstance(coords[0], (int, float)):
+            points.append(coords)
+        else:
+            for c in coords:
+                walk(c)
+
+    walk(location['coordinates'])
+    lons = [p[0] for p in points]
+    lats = [p[1] for p in points]
+    return min(lons), max(lons), min(lats), max(lats)
+
+
+class SceneIndex(object):
+
+    def __init__(self, path):
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # jobs on the same host write to the index side by side
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.executescript(SCHEMA)
+        # indexes made before scenes carried their dataset version
+        if 'version' not in [row[1] for row in self.conn.execute("PRAGMA table_info(scenes)")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE scenes ADD COLUMN version TEXT")
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, metadata, dataset, met_file=None):
+        """Index a scene from the metadata / dataset dicts written to its met.json / dataset.json"""
+        id = metadata['prod_name']
+        location = dataset.get('location') or metadata['location']
+        with self.conn:
+            self.conn.execute("DELETE FROM scenes_bbox WHERE pk IN (SELECT pk FROM scenes WHERE id = ?)", (id,))
+            self.conn.execute("DELETE FROM scenes WHERE id = ?", (id,))
+            cur = self.conn.execute("INSERT INTO scenes (%s, indexed_at) VALUES (%s)"
+                                    % (", ".join(COLUMNS), ", ".join("?" * (len(COLUMNS) + 1))),
+                                    (id, id[:21], metadata.get('dataset'), metadata.get('trackNumber'),
+                                     metadata.get('frameID'), metadata.get('level'),
+                                     dataset['starttime'], dataset['endtime'], json.dumps(location),
+                                     os.path.abspath(met_file) if met_file else None,
+                                     dataset.get('version'), datetime.utcnow().isoformat()))
+            self.conn.execute("INSERT INTO scenes_bbox VALUES (?, ?, ?, ?, ?)", (cur.lastrowid,) + _bbox(location))
+
+    def add_met_file(self, met_file):
+        """Index a scene from its met.json and the dataset.json next to it"""
+        dataset_file = met_file[:-len(".met.json")] + ".dataset.json"
+        metadata = json.load(open(met_file))
+        dataset = json.load(open(dataset_file))
+        self.add(metadata, dataset, met_file)
+
+    def has_scene(self, id):
+        return self.conn.execute("SELECT 1 FROM scenes WHERE id = ?", (id,)).fetchone() is not None
+
+    def existing(self, ids):
+        """Subset of ids that are in the index"""
+        ids = list(ids)
+        found = set()
+        for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + QUERY_CHUNK_SIZE]
+            rows = self.conn.execute("SELECT id FROM scenes WHERE id IN (%s)" % ", ".join("?" * len(chunk)), chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def versions(self, ids):
+        """Dataset version of each of ids that is in the index, as id -> version"""
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + QUERY_CHUNK_SIZE]
+            rows = self.conn.execute("SELECT id, version FROM scenes WHERE id IN (%s)"
+                                     % ", ".join("?" * len(chunk)), chunk)
+            found.update(rows)
+        return found
+
+    def existing_scene_ids(self, scene_ids):
+        """Subset of the scene IDs (ALOS2xxxxxxxxx-yymmdd) that have any product in the index"""
+        scene_ids = list(scene_ids)
+        found = set()
+        for i in range(0, len(scene_ids), QUERY_CHUNK_SIZE):
+            chunk = scene_ids[i:i + QUERY_CHUNK_SIZE]
+            rows = self.conn.execute("SELECT scene_id FROM scenes WHERE scene_id IN (%s)"
+                                     % ", ".join("?" * len(chunk)), chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def has_product(self, scene_id, level):
+        """True if a product of the scene at this level (e.g. L1.1) was made, metadata-only (-md) entries aside"""
+        return self.conn.execute("SELECT 1 FROM scenes WHERE scene_id = ? AND level = ? AND id NOT LIKE '%-md'",
+                                 (scene_id, level)).fetchone() is not None
+
+    def query(self, bbox=None, start=None, end=None, track=None, frame=None, level=None):
+        """
+        Scenes whose footprint bounding box intersects bbox (min_lon, min_lat, max_lon, max_lat)
+        and whose time range overlaps [start, end] (ISO strings), as dicts
+        """
+        sql = "SELECT %s FROM scenes s" % ", ".join("s." + c for c in COLUMNS)
+        where = []
+        params = []
+        if bbox:
+            sql += " JOIN scenes_bbox b ON b.pk = s.pk"
+            where.append("b.max_lon >= ? AND b.min_lon <= ? AND b.max_lat >= ? AND b.min_lat <= ?")
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        if start:
+            where.append("s.endtime >= ?")
+            params.append(start)
+        if end:
+            where.append("s.starttime <= ?")
+            params.append(end)
+        for column, value in (('track', track), ('frame', frame), ('level', level)):
+            if value is not None:
+                where.append("s.%s = ?" % column)
+                params.append(value)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.conn.execute(sql + " ORDER BY s.starttime", params)
+        return [dict(zip(COLUMNS, row), location=json.loads(row[COLUMNS.index('location')])) for row in rows]
+
+    def rebuild(self, dirs):
+        """Re-create the index from every met.json under dirs, returns the number of scenes indexed"""
+        with self.conn:
+            self.conn.execute("DELETE FROM scenes_bbox")
+            self.conn.execute("DELETE FROM scenes")
+        count = 0
+        for top in dirs:
+            for met_file in glob.iglob(os.path.join(top, '**', '*.met.json'), recursive=True):
+                try:
+                    self.add_met_file(met_file)
+                    count += 1
+                except (OSError, ValueError, KeyError) as e:
+                    logging.warning("Unable to index %s: %s" % (met_file, e))
+        return count
+
+
+def cmdLineParse():
+    '''
+    Command line parser.
+    '''
+    parser = argparse.ArgumentParser(description='Rebuild or query the local index of produced ALOS2 scenes')
+    parser.add_argument('-index', dest='index', type=str, default=default_path(),
+                        help='scene index database, defaults to $ALOS2_SCENE_INDEX')
+    parser.add_argument('-rebuild', dest='rebuild', type=str, nargs='+', default=None,
+                        help='re-create the index from the met.json / dataset.json files under these directories')
+    parser.add_argument('-bbox', dest='bbox', type=float, nargs=4, default=None,
+                        help='min_lon min_lat max_lon max_lat the footprint must intersect')
+    parser.add_argument('-start', dest='start', type=str, default=None,
+                        help='scenes ending after this time (YYYY-MM-DD[THH:MM:SS])')
+    parser.add_argument('-end', dest='end', type=str, default=None,
+                        help='scenes starting before this time (YYYY-MM-DD[THH:MM:SS])')
+    parser.add_argument('-track', dest='track', type=int, default=None, help='path number')
+    parser.add_argument('-frame', dest='frame', type=int, default=None, help='frame number')
+    parser.add_argument('-level', dest='level', type=str, default=None, help='product level, e.g. L1.1')
+    args = parser.parse_args()
+    if not args.index:
+        parser.error("Please specify -index or set $ALOS2_SCENE_INDEX")
+    return args
+
+
+if __name__ == "__main__":
+    args = cmdLineParse()
+    index = SceneIndex(args.index)
+    if args.rebuild:
+        print("Indexed {} scenes".format(index.rebuild(args.rebuild)))
+    else:
+        for scene in index.query(args.bbox, args.start, args.end, args.track, args.frame, args.level):
+            print(json.dumps(scene))
+    index.close()
@@ -31,29 +31,43 @@
 # https://github.com/bakerunavco/Archive-Tools/blob/master/alos2/auig2_download.py
 
 import os
+import re
 import sys
 import time
-import datetime
-import urllib.request, urllib.parse, urllib.error
-import urllib.request, urllib.error, urllib.parse
-import http.cookiejar
+import struct
+import hashlib
 import argparse
+import requests
 
 
 BASE_URL = 'https://auig2.jaxa.jp/openam/UI/Login'
+DOWNLOAD_URL = 'http://auig2.jaxa.jp/pp/service/download?downloadurl=/start/download/file&itemname=%s&itemtype=1'
 USERNAME='' # YOUR USERNAME CAN ALOS BE HARDWIRED HERE
 PASSWORD='' # YOUR PASSWORD CAN ALOS BE HARDWIRED HERE
+USER_AGENT = 'Mozilla/4.0 (compatible; MSIE 6.z0; Windows NT 5.2; .NET CLR 1.1.4322)'
 
-def loginToAUIG2(opener,inps):
+CHUNK = 256 * 1024
+# attempts after a dropped connection, each resuming where the last one stopped
+MAX_RETRIES = 8
+BACKOFF = 5
+TIMEOUT = (60, 300)
+# the end of central directory record is in the last 22 bytes + up to 64KB of zip comment
+ZIP_TAIL = 22 + 65535
+ZIP_EOCD_SIG = b'PK\x05\x06'
+ZIP_CD_SIG = b'PK\x01\x02'
+ZIP64_LOCATOR_SIG = b'PK\x06\x07'
+
+def loginToAUIG2(session,inps):
     """
-    Handle login. This should populate our cookie jar.
+    Handle login. The GET sets the cookies the login POST needs.
     """
-    login_data = urllib.parse.urlencode({
+    session.get(BASE_URL, timeout=TIMEOUT)
+    response = session.post(BASE_URL, data={
         'IDToken1' : inps.username,
         'IDToken2' : inps.password,
-    }).encode("utf-8")
-    response = opener.open(BASE_URL, login_data)
-    return response.read().decode("utf-8")
+    }, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.text
 
 def parse():
     '''Command line parser.'''
@@ -73,46 +87,141 @@ auig2_download.py -o ORDER_ID
     inps = parser.parse_args()
     return inps
 
+def check_zip_tail(filename, filesize, tail):
+    """
+    Sanity check of a downloaded zip from its last bytes: the end of central directory record
+    must be there and point at a central directory that ends right before it.
+    """
+    pos = tail.rfind(ZIP_EOCD_SIG)
+    if pos < 0 or len(tail) - pos < 22:
+        raise RuntimeError("%s is corrupt: no zip end of central directory record" % filename)
+    eocd_offset = filesize - len(tail) + pos
+    cd_size, cd_offset = struct.unpack('<II', tail[pos + 12:pos + 20])
+    if cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        # zip64, the real offsets are in the zip64 end of central directory record
+        if tail[pos - 20:pos - 16] != ZIP64_LOCATOR_SIG:
+            raise RuntimeError("%s is corrupt: no zip64 end of central directory locator" % filename)
+        return
+    if cd_offset + cd_size != eocd_offset:
+        raise RuntimeError("%s is corrupt: central directory at %s+%s does not end at %s"
+                           % (filename, cd_offset, cd_size, eocd_offset))
+    with open(filename, 'rb') as fp:
+        fp.seek(cd_offset)
+        if cd_size and fp.read(4) != ZIP_CD_SIG:
+            raise RuntimeError("%s is corrupt: no central directory at %s" % (filename, cd_offset))
+
+def _hash_prefix(filename, sha):
+    """Feed an existing partial download to the rolling hash, returns its tail"""
+    tail = b''
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK), b''):
+            sha.update(chunk)
+            tail = (tail + chunk)[-ZIP_TAIL:]
+    return tail
+
+def _content_disposition(session, url):
+    """Content-Disposition of url from a HEAD request, or from a one byte GET where HEAD
+       fails or leaves it out. None if neither sends one."""
+    h = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if h.ok and 'Content-Disposition' in h.headers:
+        return h.headers['Content-Disposition']
+    # the body is never read, closing the response drops it
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        return r.headers.get('Content-Disposition')
+
 def download(inps):
-    ### OPEN A CONNECTION TO AUIG2 AND LOG IN ###
-    cookie_filename = "cookie_%s.txt" % datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    cj = http.cookiejar.MozillaCookieJar(cookie_filename)
-    if os.access(cookie_filename, os.F_OK):
-        cj.load()
-    opener = urllib.request.build_opener(
-        urllib.request.HTTPRedirectHandler(),
-        urllib.request.HTTPHandler(debuglevel=0),
-        urllib.request.HTTPSHandler(debuglevel=0),
-        urllib.request.HTTPCookieProcessor(cj)
-    )
-    opener.addheaders = [('User-agent', ('Mozilla/4.0 (compatible; MSIE 6.z0; ' 'Windows NT 5.2; .NET CLR 1.1.4322)'))]
-    # need this twice - once to set cookies, once to log in...
-    loginToAUIG2(opener, inps)
-    loginToAUIG2(opener, inps)
+    ### OPEN A SESSION TO AUIG2 AND LOG IN ###
+    s = requests.Session()
+    s.headers['User-agent'] = USER_AGENT
+    loginToAUIG2(s, inps)
 
     ### DOWNLOAD THE FILE WITH THE GIVEN ORDER ID ###
-    url = "http://auig2.jaxa.jp/pp/service/download?downloadurl=/start/download/file&itemname=%s&itemtype=1" % inps.order_id
-    f = opener.open(url)
+    url = DOWNLOAD_URL % inps.order_id
     print("Downloading from url: %s " % url)
-    print("Header reply: %s " % f.headers['Content-Disposition'])
-    filename = f.headers['Content-Disposition'].split("=")[-1].strip()
-    print("ALOS-2 AUIG2 Download:", filename)
     start = time.time()
-    CHUNK = 256 * 1024
-    # meta = f.info()
-    filesize = f.getheader("Content-Length")
-    print("Content-Length: %s" % filesize)
-    count = 0
-
-    with open(filename, 'wb') as fp:
-        while True:
-            count += 1
-            chunk = f.read(CHUNK)
-            if not chunk: break
-            fp.write(chunk)
-            if not count % 20:
-                print("Wrote %s chunks: %s MB " % (count, str(count * CHUNK / (1024 * 1024))))
-    f.close()
+    filename = None
+    filesize = None
+    # rolling hash, zip tail and size of what is on disk, carried across attempts
+    sha = None
+    tail = b''
+    written = 0
+    attempt = 0
+    while True:
+        try:
+            if filename is None:
+                # the headers alone give the file name, before any Range request
+                disposition = _content_disposition(s, url)
+                if not disposition:
+                    raise RuntimeError("AUIG2 did not return a file for order %s, check the login and order ID"
+                                       % inps.order_id)
+                filename = disposition.split("=")[-1].strip().replace('"', '')
+                print("Header reply: %s " % disposition)
+                print("ALOS-2 AUIG2 Download:", filename)
+                sha = hashlib.sha256()
+                if os.path.exists(filename) and os.path.getsize(filename) > 0:
+                    # partial file from an earlier run, hash it once and ask for the rest of it
+                    tail = _hash_prefix(filename, sha)
+                    written = os.path.getsize(filename)
+
+            headers = {'Range': 'bytes=%s-' % written} if written else {}
+            with s.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+                if r.status_code == 416 and written:
+                    # an earlier run already got all of it
+                    m = re.match(r'bytes \*/(\d+)', r.headers.get('Content-Range', ''))
+                    filesize = int(m.group(1)) if m else written
+                    break
+                r.raise_for_status()
+
+                if r.status_code == 206:
+                    m = re.match(r'bytes (\d+)-\d+/(\d+)', r.headers.get('Content-Range', ''))
+                    if not m or int(m.group(1)) != written:
+                        raise RuntimeError("Unexpected Content-Range for %s: %s" % (filename, r.headers.get('Content-Range')))
+                    filesize = int(m.group(2))
+                    mode = 'ab'
+                    print("Resuming %s at %s of %s bytes" % (filename, written, filesize))
+                else:
+                    # the server sent the whole file
+                    filesize = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                    sha = hashlib.sha256()
+                    tail = b''
+                    written = 0
+                    mode = 'wb'
+                    print("Content-Length: %s" % filesize)
+
+                with open(filename, mode) as fp:
+                    for chunk in r.iter_content(CHUNK):
+                        fp.write(chunk)
+                        sha.update(chunk)
+                        tail = (tail + chunk)[-ZIP_TAIL:]
+                        written += len(chunk)
+                        if written // (CHUNK * 20) != (written - len(chunk)) // (CHUNK * 20):
+                            print("Wrote %s MB " % (written // (1024 * 1024)))
+            if filesize is not None and written != filesize:
+                raise requests.exceptions.ChunkedEncodingError(
+                    "Connection closed at %s of %s bytes" % (written, filesize))
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.HTTPError) as e:
+            if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code < 500:
+                raise
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise
+            wait = BACKOFF * 2 ** (attempt - 1)
+            print("Download interrupted (%s), retrying in %s s (%s/%s)" % (e, wait, attempt, MAX_RETRIES))
+            time.sleep(wait)
+
+    ### VERIFY THE FILE AS IT LANDS ###
+    if filesize is not None and os.path.getsize(filename) != filesize:
+        raise RuntimeError("%s is %s bytes, expected %s" % (filename, os.path.getsize(filename), filesize))
+    if filename.lower().endswith('.zip'):
+        check_zip_tail(filename, os.path.getsize(filename), tail)
+    digest = sha.hexdigest()
+    with open(filename + '.sha256', 'w') as fp:
+        fp.write("%s  %s\n" % (digest, os.path.basename(filename)))
+    print("SHA256: %s" % digest)
+
     total_time = time.time() - start
     mb_sec = (os.path.getsize(filename) / (1024 * 1024.0)) / total_time
     print("Speed: %s MB/s" % mb_sec)
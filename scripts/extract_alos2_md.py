@@ -7,10 +7,31 @@ import argparse
 import datetime
 import json
 import re
+import shutil
+import struct
+import tempfile
 import requests
+import numpy as np
 
-def create_alos2app_xml(dir_name):
-    fp = open('alos2App.xml', 'w')
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_E2 = 0.0066943799901
+SPEED_OF_LIGHT = 299792458.0
+
+# CEOS record type codes (6th byte of each record)
+CEOS_DATASET_SUMMARY = 10
+CEOS_PLATFORM_POSITION = 30
+
+# prefix of each L1.1 SLC line, followed by complex float32 pixels
+CEOS_SLC_PREFIX = 544
+
+ORBIT_INTERP_POINTS = 8
+RDR2GEO_ITERATIONS = 10
+
+ALOS2_IMG_REGEX = re.compile(r'IMG-[A-Z]{2}-(ALOS2)(.{05})(.{04})-(\d{6})-[A-Z0-9]{3}([LR]).*')
+
+def create_alos2app_xml(dir_name, work_dir="."):
+    fp = open(os.path.join(work_dir, 'alos2App.xml'), 'w')
     fp.write('<alos2App>\n')
     fp.write('    <component name="alos2insar">\n')
     fp.write('        <property name="master directory">{}</property>\n'.format(os.path.abspath(dir_name)))
@@ -33,14 +54,14 @@ def loadProduct(xmlname):
     return obj
 
 
-def loadTrack(date):
+def loadTrack(date, work_dir="."):
     '''
     date: YYMMDD
     '''
     # from Cunren's code on extracting track data from alos2App
-    track = loadProduct('{}.track.xml'.format(date))
+    track = loadProduct(os.path.join(work_dir, '{}.track.xml'.format(date)))
     track.frames = []
-    frameParameterFiles = sorted(glob.glob(os.path.join('f*_*', '{}.frame.xml'.format(date))))
+    frameParameterFiles = sorted(glob.glob(os.path.join(work_dir, 'f*_*', '{}.frame.xml'.format(date))))
     for x in frameParameterFiles:
         track.frames.append(loadProduct(x))
     return track
@@ -102,7 +123,7 @@ def getMetadataFromISCE(track):
     return footprint, azimuthTimeMin, azimuthTimeMax
 
 
-def get_alos2_obj(dir_name):
+def get_alos2_obj(dir_name, work_dir="."):
     track = None
     img_file = sorted(glob.glob(os.path.join(dir_name, 'IMG*')))
 
@@ -110,9 +131,9 @@ def get_alos2_obj(dir_name):
         match = re.search('IMG-[A-Z]{2}-(ALOS2)(.{05})(.{04})-(\d{6})-.{4}.*',img_file[0])
         if match:
             date = match.group(4)
-            create_alos2app_xml(dir_name)
-            check_output("alos2App.py --steps --end=preprocess", shell=True)
-            track = loadTrack(date)
+            create_alos2app_xml(dir_name, work_dir)
+            check_output("alos2App.py --steps --end=preprocess", shell=True, cwd=work_dir)
+            track = loadTrack(date, work_dir)
             track.spacecraftName = match.group(1)
             track.orbitNumber = match.group(2)
             track.frameNumber = match.group(3)
@@ -120,10 +141,7 @@ def get_alos2_obj(dir_name):
     return track
 
 
-def create_alos2_md_isce(dirname, filename):
-    track = get_alos2_obj(dirname)
-
-    bbox, sensingStart, sensingEnd = getMetadataFromISCE(track)
+def _md_from_footprint(bbox, sensingStart, sensingEnd, orbitNumber, frameNumber, passDirection, spacecraftName, source):
     md = {}
     md['geometry'] = {
         "coordinates":[[
@@ -137,17 +155,190 @@ def create_alos2_md_isce(dirname, filename):
     }
     md['start_time'] = sensingStart.strftime("%Y-%m-%dT%H:%M:%S.%f")
     md['stop_time'] = sensingEnd.strftime("%Y-%m-%dT%H:%M:%S.%f")
-    md['absolute_orbit'] = track.orbitNumber
-    md['frame'] = track.frameNumber
-    md['flight_direction'] = 'asc' if 'asc' in track.catalog['passdirection'] else 'dsc'
-    md['satellite_name'] = track.spacecraftName
-    md['source'] = "isce_preprocessing"
+    md['absolute_orbit'] = orbitNumber
+    md['frame'] = frameNumber
+    md['flight_direction'] = 'asc' if 'asc' in passDirection else 'dsc'
+    md['satellite_name'] = spacecraftName
+    md['source'] = source
+    return md
 
-    with open(filename, "w") as f:
-        json.dump(md, f, indent=2)
-        f.close()
 
-def create_alos2_md_bos(dir_name, filename):
+def get_alos2_md_isce(dirname):
+    # preprocess in a directory of its own, so scenes processed side by side do not collide
+    work_dir = tempfile.mkdtemp(prefix="alos2App_", dir=os.getcwd())
+    try:
+        track = get_alos2_obj(dirname, work_dir)
+        bbox, sensingStart, sensingEnd = getMetadataFromISCE(track)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return _md_from_footprint(bbox, sensingStart, sensingEnd, track.orbitNumber, track.frameNumber,
+                              track.catalog['passdirection'], track.spacecraftName, "isce_preprocessing")
+
+
+def _ceos_records(data):
+    """{record type code: record bytes} of a CEOS file, walking the 12 byte record headers"""
+    records = {}
+    offset = 0
+    while offset + 12 <= len(data):
+        rec_type = data[offset + 5]
+        rec_len = struct.unpack('>I', data[offset + 8:offset + 12])[0]
+        if rec_len < 12:
+            break
+        records.setdefault(rec_type, data[offset:offset + rec_len])
+        offset += rec_len
+    return records
+
+
+def _ceos_field(record, start, end):
+    """ascii field at 1-based inclusive byte positions, as in the format description"""
+    return record[start - 1:end].decode('ascii').strip()
+
+
+def _ceos_float(record, start, end):
+    return float(_ceos_field(record, start, end).replace('D', 'E'))
+
+
+def read_ceos_leader(led_file):
+    """Range sampling rate (Hz) and orbit state vectors from a CEOS leader file"""
+    with open(led_file, 'rb') as f:
+        records = _ceos_records(f.read())
+    dss = records[CEOS_DATASET_SUMMARY]
+    ppr = records[CEOS_PLATFORM_POSITION]
+
+    npoints = int(_ceos_field(ppr, 141, 144))
+    t0 = datetime.datetime(int(_ceos_field(ppr, 145, 148)), int(_ceos_field(ppr, 149, 152)),
+                           int(_ceos_field(ppr, 153, 156))) + \
+         datetime.timedelta(seconds=_ceos_float(ppr, 161, 182))
+    interval = _ceos_float(ppr, 183, 204)
+    # npoints x (x, y, z, vx, vy, vz) in an earth fixed frame, D22.15 each
+    state = np.array([_ceos_float(ppr, 387 + 22 * i, 408 + 22 * i) for i in range(6 * npoints)]).reshape(npoints, 6)
+
+    return {
+        'range_sampling_rate': _ceos_float(dss, 711, 726) * 1e6,
+        'orbit_epoch': t0,
+        'orbit_times': np.arange(npoints) * interval,
+        'orbit_state': state
+    }
+
+
+def _ceos_line_time(record):
+    year, doy, msec = struct.unpack('>III', record[36:48])
+    return datetime.datetime(year, 1, 1) + datetime.timedelta(days=doy - 1, milliseconds=msec)
+
+
+def read_ceos_slc_extent(img_file):
+    """(first line time, last line time, near slant range, pixels per line) from the first and last line of a SLC"""
+    size = os.path.getsize(img_file)
+    with open(img_file, 'rb') as f:
+        fd_len = struct.unpack('>I', f.read(12)[8:12])[0]
+        f.seek(fd_len)
+        first = f.read(CEOS_SLC_PREFIX)
+        rec_len = struct.unpack('>I', first[8:12])[0]
+        nlines = (size - fd_len) // rec_len
+        f.seek(fd_len + (nlines - 1) * rec_len)
+        last = f.read(CEOS_SLC_PREFIX)
+
+    near_range = struct.unpack('>I', first[116:120])[0]
+    return _ceos_line_time(first), _ceos_line_time(last), float(near_range), (rec_len - CEOS_SLC_PREFIX) // 8
+
+
+def interpolate_orbit(orbit_times, orbit_state, t):
+    """Lagrange interpolation of the state vectors at times t (seconds since the orbit epoch), returns (m, 6)"""
+    n = min(ORBIT_INTERP_POINTS, len(orbit_times))
+    i0 = np.clip(np.searchsorted(orbit_times, t) - n // 2, 0, len(orbit_times) - n)
+    idx = i0[:, None] + np.arange(n)
+    tt = orbit_times[idx]
+    w = np.ones(idx.shape)
+    for j in range(n):
+        for k in range(n):
+            if k != j:
+                w[:, j] *= (t - tt[:, k]) / (tt[:, j] - tt[:, k])
+    return np.einsum('mj,mjc->mc', w, orbit_state[idx])
+
+
+def rdr2geo(pos, vel, rng, side='right'):
+    """
+    Zero doppler points on the ellipsoid at slant ranges rng from satellites at pos moving with vel
+    (earth fixed, (m, 3) each). Returns (m, 3) of lat, lon, height.
+    """
+    b2 = WGS84_A ** 2 * (1 - WGS84_E2)
+    axes = np.array([WGS84_A ** 2, WGS84_A ** 2, b2])
+
+    # first guess on a sphere with the radius of the ellipsoid below the satellite
+    sat_radius = np.linalg.norm(pos, axis=1)
+    nadir = -pos / sat_radius[:, None]
+    earth_radius = 1 / np.sqrt(np.sum(nadir ** 2 / axes, axis=1))
+    cos_look = (sat_radius ** 2 + rng ** 2 - earth_radius ** 2) / (2 * sat_radius * rng)
+    cross = np.cross(nadir, vel)
+    cross /= np.linalg.norm(cross, axis=1)[:, None]
+    if side == 'left':
+        cross = -cross
+    target = pos + rng[:, None] * (cos_look[:, None] * nadir + np.sqrt(1 - cos_look ** 2)[:, None] * cross)
+
+    # newton iterations on |T - P| = r, (T - P).V = 0 and T on the ellipsoid
+    for _ in range(RDR2GEO_ITERATIONS):
+        los = target - pos
+        f = np.stack([np.sum(los ** 2, axis=1) - rng ** 2,
+                      np.sum(los * vel, axis=1),
+                      np.sum(target ** 2 / axes, axis=1) - 1], axis=1)
+        jac = np.stack([2 * los, vel, 2 * target / axes], axis=1)
+        target -= np.linalg.solve(jac, f[:, :, None])[:, :, 0]
+
+    lat = np.degrees(np.arctan2(target[:, 2], (1 - WGS84_E2) * np.hypot(target[:, 0], target[:, 1])))
+    lon = np.degrees(np.arctan2(target[:, 1], target[:, 0]))
+    return np.stack([lat, lon, np.zeros(len(lat))], axis=1)
+
+
+def get_alos2_md_ceos(dir_name):
+    """Metadata from the CEOS leader and the first and last line of the IMG files, without ISCE"""
+    led_file = sorted(glob.glob(os.path.join(dir_name, 'LED*')))
+    img_files = sorted(glob.glob(os.path.join(dir_name, 'IMG*')))
+    if not led_file or not img_files:
+        raise RuntimeError("Unable to find the LED and IMG files in {}".format(dir_name))
+    match = ALOS2_IMG_REGEX.search(os.path.basename(img_files[0]))
+    if not match:
+        raise RuntimeError("Unable to parse the IMG file name {}".format(img_files[0]))
+    side = 'right' if match.group(5) == 'R' else 'left'
+
+    leader = read_ceos_leader(led_file[0])
+    range_spacing = SPEED_OF_LIGHT / (2 * leader['range_sampling_rate'])
+
+    # extent over all swaths / polarisations, as getBboxRdr does
+    extents = [read_ceos_slc_extent(f) for f in img_files]
+    sensingStart = min(e[0] for e in extents)
+    sensingEnd = max(e[1] for e in extents)
+    rangeMin = min(e[2] for e in extents)
+    rangeMax = max(e[2] + (e[3] - 1) * range_spacing for e in extents)
+
+    # corners in image coordinate, 1: (start, near) 2: (start, far) 3: (end, near) 4: (end, far)
+    epoch = leader['orbit_epoch']
+    t = np.array([(sensingStart - epoch).total_seconds()] * 2 + [(sensingEnd - epoch).total_seconds()] * 2)
+    rng = np.array([rangeMin, rangeMax, rangeMin, rangeMax])
+    state = interpolate_orbit(leader['orbit_times'], leader['orbit_state'], t)
+    llh1, llh2, llh3, llh4 = rdr2geo(state[:, :3], state[:, 3:], rng, side).tolist()
+    passDirection = 'ascending' if state[0, 5] > 0 else 'descending'
+
+    # re-sort in geography coordinate, as getMetadataFromISCE does
+    if passDirection == 'descending':
+        footprint = [llh2, llh1, llh4, llh3] if side == 'right' else [llh1, llh2, llh3, llh4]
+    else:
+        footprint = [llh4, llh3, llh2, llh1] if side == 'right' else [llh3, llh4, llh1, llh2]
+
+    return _md_from_footprint(footprint, sensingStart, sensingEnd, match.group(2), match.group(3),
+                              passDirection, match.group(1), "ceos_leader")
+
+
+def verify_alos2_md_ceos(dir_name, md):
+    """Compare the CEOS leader footprint in md against ISCE preprocessing, recording the largest corner offset"""
+    md_isce = get_alos2_md_isce(dir_name)
+    diff = np.abs(np.array(md['geometry']['coordinates']) - np.array(md_isce['geometry']['coordinates'])).max()
+    print("Largest footprint corner difference from ISCE: {} deg".format(diff))
+    md['isce_max_corner_diff_deg'] = float(diff)
+    return md
+
+
+def get_alos2_md_bos(dir_name):
     img_file = sorted(glob.glob(os.path.join(dir_name, 'IMG*')))
     geo_server = "https://portal.bostechnologies.com/geoserver/bos/ows?service=WFS&version=1.0.0&request=GetFeature&typeName=bos:sarcat&maxFeatures=50&outputFormat=json"
     if len(img_file) > 0:
@@ -163,9 +354,36 @@ def create_alos2_md_bos(dir_name, filename):
         # move properties a level up
         md.update(md['properties'])
         del md['properties']
-        with open(filename, "w") as f:
-            json.dump(md, f, indent=2)
-            f.close()
+        return md
+    raise RuntimeError("Unable to find any ALOS2 image files in {}".format(dir_name))
+
+def extract_metadata(dir_name, method="", verify=False):
+    """
+    Metadata of the L1.1 scene in dir_name, from method "bos", "ceos" or "isce".
+    Without a method, tries bos, then the CEOS leader, then isce preprocessing.
+    """
+    if method == "bos":
+        return get_alos2_md_bos(dir_name)
+    elif method == "ceos":
+        md = get_alos2_md_ceos(dir_name)
+        return verify_alos2_md_ceos(dir_name, md) if verify else md
+    elif method == "isce":
+        return get_alos2_md_isce(dir_name)
+    elif method:
+        raise RuntimeError("Unknown metadata extraction method {}".format(method))
+
+    try:
+        return get_alos2_md_bos(dir_name)
+    except Exception as e:
+        print("Got exception trying to query bos sarcat: %s" % str(e))
+    try:
+        # compute the bbox from the leader if we are unable to get it from bos
+        md = get_alos2_md_ceos(dir_name)
+        return verify_alos2_md_ceos(dir_name, md) if verify else md
+    except Exception as e:
+        print("Got exception trying to read the CEOS leader: %s" % str(e))
+    # use isce as the last resort
+    return get_alos2_md_isce(dir_name)
 
 def cmdLineParse():
     '''
@@ -177,26 +395,13 @@ def cmdLineParse():
     parser.add_argument('--output', dest='op_json', type=str, default="alos2_md.json",
                         help='json file name to output metadata to')
     parser.add_argument('--method', dest='method', type=str, default="",
-                        help='either "bos" (to get md from bos) or "isce" (to get md from isce preprocessing) or empty (to get from bos, fallback isce)')
+                        help='either "bos" (to get md from bos), "ceos" (to compute md from the CEOS leader), "isce" (to get md from isce preprocessing) or empty (to get from bos, fallback ceos, then isce)')
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='when the md comes from the CEOS leader, also run isce preprocessing and record the footprint difference')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = cmdLineParse()
-    if args.method == "bos":
-        create_alos2_md_bos(args.alos2dir, args.op_json)
-    elif args.method == "isce":
-        insar_obj = get_alos2_obj(args.alos2dir)
-        create_alos2_md_isce(insar_obj, args.op_json)
-    else:
-        try:
-            create_alos2_md_bos(args.alos2dir, args.op_json)
-        except Exception as e:
-            print("Got exception trying to query bos sarcat: %s" % str(e))
-            # use isce if we are unable to get the bbox from bos
-            create_alos2_md_isce(args.alos2dir, args.op_json)
-
-
-
-
-
-
+    md = extract_metadata(args.alos2dir, args.method, args.verify)
+    with open(args.op_json, "w") as f:
+        json.dump(md, f, indent=2)
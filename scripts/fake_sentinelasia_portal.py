@@ -0,0 +1,190 @@
+#! /usr/bin/env python3
+"""
+Local stand-in for the Sentinel-Asia portal, serving the login, EOR list, EOR catalog, bulletin and
+download endpoints sentinelasia_download.py uses, so the crawler and downloader can be run offline.
+
+    fake_sentinelasia_portal.py -port 8780     serve it, then run sentinelasia_download.py -base_url http://127.0.0.1:8780/sentinel2
+    fake_sentinelasia_portal.py -check         crawl and download from it in-process and compare the results,
+                                               with the first transfer of every file cut off halfway
+"""
+
+import os
+import re
+import socket
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import http.server
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+try:
+    from scripts import sentinelasia_download as sa
+except ImportError:
+    import sentinelasia_download as sa
+
+EORS = 6
+FILES_PER_EOR = 3
+FILE_SIZE = 3 * 1024 * 1024
+
+
+def make_portal(eors=EORS, files_per_eor=FILES_PER_EOR, file_size=FILE_SIZE, seed=0, drop_first=False):
+    """Bulletins, catalogs and file contents of a fake portal, EORs observed over the last days.
+       With drop_first, the first download of each file is cut off halfway."""
+    rng = random.Random(seed)
+    today = datetime.today()
+    portal = {'bulletins': [], 'catalogs': {}, 'files': {}, 'drop_first': drop_first, 'dropped': set()}
+    for i in range(eors):
+        request_id = "ERFAKE%06d" % i
+        observed = today - timedelta(days=i)
+        portal['bulletins'].append({"requestId": request_id, "observeDateStr": observed.strftime('%d/%b/%Y'),
+                                    "disasterTypeStr": "Flood", "countryStr": "Nowhere"})
+        catalog = []
+        for j in range(files_per_eor):
+            data_id = "JPFAKE%06d%04d" % (i, j)
+            scene = "ALOS2%05d%04d-%s" % (10000 + i * 10 + j, 2900 + j * 10, observed.strftime('%y%m%d'))
+            portal['files'][data_id] = {"filename": "%s-WBDR1.5RUD.zip" % scene,
+                                        "content": rng.randbytes(file_size)}
+            catalog.append({"typeStr": "ALOS(Data)", "dataId": data_id, "title": scene + "-WBDR1.5RUD"})
+        catalog.append({"typeStr": "Map", "dataId": "MAP%06d" % i, "title": "map"})
+        portal['catalogs'][request_id] = catalog
+    return portal
+
+
+def make_handler(portal):
+    paths = {name: urlparse(path).path for name, path in (
+        ('login', sa.LOGIN_PATH), ('eor_list', sa.EOR_LIST_PATH), ('eor_files', sa.EOR_ID_FILES_PATH),
+        ('bulletin', sa.EOR_ID_BULLETIN_PATH), ('download', sa.DL_PATH))}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body=b'', headers=None):
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def _json(self, value):
+            self._send(200, json.dumps(value).encode('utf-8'), {'Content-Type': 'application/json'})
+
+        def _route(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path.endswith(paths['login']):
+                if self.command == 'POST':
+                    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                return self._send(200, b'ok', {'Set-Cookie': 'JSESSIONID=fake; Path=/'})
+            if url.path.endswith(paths['eor_list']):
+                return self._json(portal['bulletins'])
+            if url.path.endswith(paths['eor_files']):
+                return self._json(portal['catalogs'].get(query.get('requestId'), []))
+            if url.path.endswith(paths['bulletin']):
+                return self._json(next(b for b in portal['bulletins'] if b['requestId'] == query.get('requestId')))
+            if url.path.endswith(paths['download']) and query.get('dataId') in portal['files']:
+                return self._file(query['dataId'], portal['files'][query['dataId']])
+            return self._send(404)
+
+        def _drop(self, status, body, headers):
+            """Send the headers and half the body, then close the connection"""
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+
+        def _file(self, data_id, f):
+            content = f['content']
+            headers = {'Content-Disposition': 'attachment; filename="%s"' % f['filename'],
+                       'ETag': '"%s"' % hashlib.sha1(content).hexdigest()}
+            m = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if self.command == 'GET' and portal['drop_first'] and data_id not in portal['dropped']:
+                portal['dropped'].add(data_id)
+                start = int(m.group(1)) if m else 0
+                if m:
+                    headers['Content-Range'] = 'bytes %d-%d/%d' % (start, len(content) - 1, len(content))
+                return self._drop(206 if m else 200, content[start:], headers)
+            if not m:
+                return self._send(200, content, headers)
+            start = int(m.group(1))
+            if start >= len(content):
+                return self._send(416, b'', {'Content-Range': 'bytes */%d' % len(content)})
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, len(content) - 1, len(content))
+            return self._send(206, content[start:], headers)
+
+        do_GET = do_HEAD = do_POST = _route
+
+    return Handler
+
+
+def serve(portal, port=0):
+    """Start the fake portal on a background thread, returns the server"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), make_handler(portal))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check():
+    """Crawl every EOR by start_time and download what was found, from a fake portal
+       that cuts off the first transfer of every file"""
+    portal = make_portal(drop_first=True)
+    server = serve(portal)
+    base_url, sa.BASE_URL = sa.BASE_URL, 'http://127.0.0.1:%d/sentinel2' % server.server_address[1]
+    backoff, sa.DOWNLOAD_BACKOFF = sa.DOWNLOAD_BACKOFF, 0
+    cwd = os.getcwd()
+    try:
+        inps = argparse.Namespace(eor_id="", data_id="", username="user", password="pass",
+                                  start_time=(datetime.today() - timedelta(days=EORS)).strftime('%Y%m%d'),
+                                  end_time=datetime.today().strftime('%Y%m%d'))
+        params = sa.get_all_params(inps)
+        found = sorted(p['data_id'] for p in params)
+        if found != sorted(portal['files']):
+            raise RuntimeError("Crawl found %s, expected %s" % (found, sorted(portal['files'])))
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            sa.do_download(inps, params)
+            for p in params:
+                with open(p['filename'], 'rb') as f:
+                    if f.read() != portal['files'][p['data_id']]['content']:
+                        raise RuntimeError("Downloaded %s does not match the portal" % p['filename'])
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        sa.BASE_URL = base_url
+        sa.DOWNLOAD_BACKOFF = backoff
+        server.shutdown()
+    print("Crawled and downloaded {} files from {} EORs, resuming {} cut off transfers"
+          .format(len(params), EORS, len(portal['dropped'])))
+
+
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Local stand-in for the Sentinel-Asia portal')
+    parser.add_argument('-port', dest='port', type=int, default=8780, help='port to serve the fake portal on')
+    parser.add_argument('-check', dest='check', action='store_true', default=False,
+                        help='crawl and download from a fake portal in-process, then exit')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse()
+    if args.check:
+        check()
+    else:
+        server = serve(make_portal(), args.port)
+        print("Fake Sentinel-Asia portal at http://127.0.0.1:%d/sentinel2" % server.server_address[1])
+        threading.Event().wait()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+"""
+Persistent catalog of Sentinel-Asia EORs and ALOS-2 data files, so repeated
+crawls only look at new or changed EORs and only submit data IDs that are unseen,
+or were re-published with another ETag or size.
+"""
+
+import os
+import json
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta
+
+DEFAULT_CATALOG = os.path.join(os.path.expanduser('~'), '.alos2_ingest', 'sentinelasia_catalog.db')
+
+# EORs observed within this many days are re-crawled every run, as new data keeps being added to them
+REFRESH_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS eors (
+    request_id TEXT PRIMARY KEY,
+    observe_date TEXT,
+    bulletin_hash TEXT,
+    crawled_at TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    data_id TEXT PRIMARY KEY,
+    request_id TEXT,
+    filename TEXT,
+    filesize INTEGER,
+    etag TEXT,
+    params TEXT,
+    discovered_at TEXT,
+    submitted_at TEXT,
+    job_name TEXT
+);
+CREATE INDEX IF NOT EXISTS files_pending ON files (submitted_at);
+"""
+
+
+def _bulletin_hash(bulletin):
+    return hashlib.sha1(json.dumps(bulletin, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class EORCatalog(object):
+
+    def __init__(self, path=DEFAULT_CATALOG, refresh_days=REFRESH_DAYS):
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.refresh_days = refresh_days
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def eor_needs_crawl(self, bulletin):
+        """True if the EOR is new, its bulletin changed, or it is recent enough to still get data"""
+        row = self.conn.execute("SELECT bulletin_hash FROM eors WHERE request_id = ?",
+                                (bulletin["requestId"],)).fetchone()
+        if row is None or row[0] != _bulletin_hash(bulletin):
+            return True
+        observed = datetime.strptime(bulletin["observeDateStr"], '%d/%b/%Y')
+        return observed >= datetime.today() - timedelta(days=self.refresh_days)
+
+    def mark_eor_crawled(self, bulletin):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO eors VALUES (?, ?, ?, ?)",
+                              (bulletin["requestId"], bulletin["observeDateStr"],
+                               _bulletin_hash(bulletin), datetime.utcnow().isoformat()))
+
+    def has_file(self, data_id):
+        return self.conn.execute("SELECT 1 FROM files WHERE data_id = ?", (data_id,)).fetchone() is not None
+
+    def add_file(self, params):
+        """
+        Record a file's parameters, as returned by get_file_params joined with its eor_data. Returns True
+        if the file is new or was re-published with another ETag or size, which makes it pending again.
+        """
+        row = self.conn.execute("SELECT filesize, etag FROM files WHERE data_id = ?", (params["data_id"],)).fetchone()
+        etag = params.get("etag", "")
+        changed = row is None or row[0] != params["filesize"] or (etag and row[1] and etag != row[1])
+        with self.conn:
+            self.conn.execute("""INSERT INTO files (data_id, request_id, filename, filesize, etag, params, discovered_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?)
+                                 ON CONFLICT(data_id) DO UPDATE SET
+                                 filename = excluded.filename, filesize = excluded.filesize,
+                                 etag = excluded.etag, params = excluded.params""",
+                              (params["data_id"], params.get("eor_id"), params["filename"], params["filesize"],
+                               etag, json.dumps(params, sort_keys=True), datetime.utcnow().isoformat()))
+            if changed and row is not None:
+                self.conn.execute("UPDATE files SET submitted_at = NULL, job_name = NULL WHERE data_id = ?",
+                                  (params["data_id"],))
+        return bool(changed)
+
+    def pending(self):
+        """Parameters of every file that has not been submitted for ingest yet"""
+        rows = self.conn.execute("SELECT params FROM files WHERE submitted_at IS NULL ORDER BY data_id")
+        return [json.loads(row[0]) for row in rows]
+
+    def mark_submitted(self, data_id, job_name):
+        with self.conn:
+            self.conn.execute("UPDATE files SET submitted_at = ?, job_name = ? WHERE data_id = ?",
+                              (datetime.utcnow().isoformat(), job_name, data_id))
@@ -5,14 +5,33 @@ import argparse
 import os
 import time
 import json
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
 from datetime import datetime
 
 
-LOGIN_URL = 'https://sentinel.tksc.jaxa.jp/sentinel2/topControl.jsp'
-EOR_LIST_URL = 'https://sentinel.tksc.jaxa.jp/sentinel2/webresources/emobRequestSelect/viewList?subset_name=Emergency+Observation&submit.countryIdx=&submit.disasterTypeIdx='
-EOR_ID_FILES = 'https://sentinel.tksc.jaxa.jp/sentinel2/webresources/thumbnailEmob/emergencyViewThumbnail?requestId={}&subsetName=Emergency+Observation&selectDate='
-EOR_ID_BULLETIN = 'https://sentinel.tksc.jaxa.jp/sentinel2/webresources/thumbnailEmob/viewBulletinContent?requestId={}'
-DL_URL = 'https://sentinel.tksc.jaxa.jp/sentinel2/webresources/thumbnailEmob/download?dataId='
+BASE_URL = 'https://sentinel.tksc.jaxa.jp/sentinel2'
+# portal endpoints, relative to BASE_URL so another portal (e.g. fake_sentinelasia_portal.py) can be swapped in
+LOGIN_PATH = '/topControl.jsp'
+EOR_LIST_PATH = '/webresources/emobRequestSelect/viewList?subset_name=Emergency+Observation&submit.countryIdx=&submit.disasterTypeIdx='
+EOR_ID_FILES_PATH = '/webresources/thumbnailEmob/emergencyViewThumbnail?requestId={}&subsetName=Emergency+Observation&selectDate='
+EOR_ID_BULLETIN_PATH = '/webresources/thumbnailEmob/viewBulletinContent?requestId={}'
+DL_PATH = '/webresources/thumbnailEmob/download?dataId='
+
+# catalog crawl concurrency, and the cap on simultaneous requests to one host
+CRAWL_WORKERS = 16
+HOST_CONCURRENCY = 8
+# simultaneous file downloads
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK = 256 * 1024
+# (connect, read) timeout of every portal request
+TIMEOUT = (60, 300)
+# attempts after a dropped or stalled transfer, each resuming from the current file size
+DOWNLOAD_RETRIES = 8
+DOWNLOAD_BACKOFF = 5
+_host_slots = {}
+_host_slots_lock = threading.Lock()
 
 def parse():
     '''Command line parser.'''
@@ -28,34 +47,68 @@ def parse():
     parser.add_argument('-dry_run', action='store_true', dest="dry_run", default=False, help='Will not downlaod files if flag is defined')
     parser.add_argument('-u','--username', action="store", dest="username", default="", help='Sentinel Asia Login, if not given, checks .netrc')
     parser.add_argument('-p','--password', action="store", dest="password", default="", help='Sentinel Asia Login, if not given, checks .netrc')
+    parser.add_argument('-base_url', action="store", dest="base_url", default=BASE_URL, help='Sentinel Asia portal, defaults to %s' % BASE_URL)
     inps = parser.parse_args()
     return inps
 
+def _url(path):
+    """Portal URL of path, from the BASE_URL in effect at call time"""
+    return BASE_URL + path
+
 def session_login(username="", password=""):
     if not (username or password):
-        creds = requests.utils.get_netrc_auth(LOGIN_URL)
+        creds = requests.utils.get_netrc_auth(_url(LOGIN_PATH))
         if creds is None:
             print("Please specify username and password, credentials cannot be found in .netrc")
             exit(0)
         username, password = creds
 
     with requests.Session() as s:
+        # one keep-alive pool shared by all crawler threads
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CRAWL_WORKERS)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
         payload = {'passwd': password, 'request': 'login', 'userid': username, 'submit': 'login', 'loginId': ''}
-        s.get(LOGIN_URL)
+        s.get(_url(LOGIN_PATH))
         header_cookie = s.cookies.get_dict()
         print(header_cookie)
         # Spoof some of the headers fo requestig
         s.headers['User-Agent'] = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:60.0) Gecko/20100101 Firefox/60.0'
         s.headers['Cookie'] = "JSESSIONID=" + header_cookie['JSESSIONID']
-        r_login = s.post(LOGIN_URL, data=payload)
+        r_login = s.post(_url(LOGIN_PATH), data=payload)
         r_login.encoding = 'utf-8'
         print("Login status code:  {}".format(r_login.status_code))
 
     return s
 
 
+def _host_slot(url):
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        return _host_slots[host]
+
+
+def _request(session, method, url, **kwargs):
+    """session.request, limited to HOST_CONCURRENCY simultaneous requests per host"""
+    kwargs.setdefault('timeout', TIMEOUT)
+    with _host_slot(url):
+        return session.request(method, url, **kwargs)
+
 
-def get_all_params(inps):
+def _crawl(fn, items):
+    """Map fn over items on the crawler thread pool, keeping the order of items"""
+    items = list(items)
+    if not items:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(CRAWL_WORKERS, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+def get_all_params(inps, catalog=None):
+    """Download parameters of everything matching inps. With a catalog (see sentinelasia_catalog),
+       a start_time search only crawls new, changed or recent EORs, and only returns their files
+       that are new or whose ETag or size changed since the last crawl."""
     s = session_login(inps.username, inps.password)
 
     all_params = []
@@ -65,13 +118,22 @@ def get_all_params(inps):
         all_params = [get_file_params(inps, inps.data_id, s)]
     elif inps.start_time:
         eor_list = get_eor_list(inps, s)
-        for eor_id_bulletin in eor_list:
-            eor_date = datetime.strptime(eor_id_bulletin["observeDateStr"],'%d/%b/%Y')
-            start = datetime.strptime(inps.start_time, '%Y%m%d')
-            end = datetime.strptime(inps.end_time, '%Y%m%d')
-            eor_id = eor_id_bulletin["requestId"]
-            if eor_date >= start and eor_date <= end:
-                all_params.extend(get_eorid_allfiles(inps, eor_id, eor_id_bulletin, s))
+        start = datetime.strptime(inps.start_time, '%Y%m%d')
+        end = datetime.strptime(inps.end_time, '%Y%m%d')
+        eor_list = [eor_id_bulletin for eor_id_bulletin in eor_list
+                    if start <= datetime.strptime(eor_id_bulletin["observeDateStr"],'%d/%b/%Y') <= end]
+        if catalog:
+            eor_list = [b for b in eor_list if catalog.eor_needs_crawl(b)]
+            print("{} EORs are new or changed since the last crawl".format(len(eor_list)))
+        # fetch all EOR catalogs concurrently, then HEAD all of their files concurrently
+        entries = _crawl(lambda b: get_eorid_entries(inps, b["requestId"], b, s), eor_list)
+        entries = [e for eor_entries in entries for e in eor_entries]
+        # known files are HEADed again too, a file re-published under its data ID is submitted again
+        all_params = get_entries_file_params(inps, entries, s)
+        if catalog:
+            all_params = [param for param in all_params if catalog.add_file(param)]
+            for eor_id_bulletin in eor_list:
+                catalog.mark_eor_crawled(eor_id_bulletin)
 
     # print statement here
     if not all_params:
@@ -92,7 +154,7 @@ def get_eor_list(inps, session=None):
     if not s:
          s = session_login(inps.username, inps.password)
 
-    r_eor_catalog = s.get(EOR_LIST_URL)
+    r_eor_catalog = _request(s, 'GET', _url(EOR_LIST_PATH))
     print("EOR list status code:  {}".format(r_eor_catalog.status_code))
     if r_eor_catalog.status_code == 200:
         catalog = r_eor_catalog.json()
@@ -102,8 +164,9 @@ def get_eor_list(inps, session=None):
         raise RuntimeError("Unable to retrieve EOR List")
 
 
-def get_eorid_allfiles(inps, eor_id, eor_id_bulletin=None, session=None):
-    all_params = []
+def get_eorid_entries(inps, eor_id, eor_id_bulletin=None, session=None):
+    """ALOS(Data) entries of an EOR catalog as (data_id, eor_data), without their file parameters"""
+    entries = []
     s = session
     if not s:
          s = session_login(inps.username, inps.password)
@@ -117,7 +180,7 @@ def get_eorid_allfiles(inps, eor_id, eor_id_bulletin=None, session=None):
                 "eor_country": eor_id_bulletin["countryStr"]
                 }
 
-    r_data_catalog = s.get(EOR_ID_FILES.format(eor_id))
+    r_data_catalog = _request(s, 'GET', _url(EOR_ID_FILES_PATH.format(eor_id)))
     print("EOR ID status code:  {}".format(r_data_catalog.status_code))
 
     if r_data_catalog.status_code == 200:
@@ -127,21 +190,35 @@ def get_eorid_allfiles(inps, eor_id, eor_id_bulletin=None, session=None):
             if "ALOS(Data)" in entry["typeStr"]:
                 data_id = entry["dataId"]
                 eor_data.update({"filetitle":entry["title"]})
-                file_params = get_file_params(inps, data_id, s)
                 print("Found ALOS(Data):{} in EOR: {} ".format(data_id, eor_id))
-                # join eor_data and file_params
-                eor_data_cp = eor_data.copy()
-                file_params.update(eor_data_cp)
-                all_params.append(file_params)
+                entries.append((data_id, eor_data.copy()))
 
-    return all_params
+    return entries
+
+def get_entries_file_params(inps, entries, session):
+    """HEAD the files of (data_id, eor_data) entries concurrently and join them with their eor_data"""
+    def file_params(entry):
+        data_id, eor_data = entry
+        file_params = get_file_params(inps, data_id, session)
+        # join eor_data and file_params
+        file_params.update(eor_data)
+        return file_params
+
+    return _crawl(file_params, entries)
+
+def get_eorid_allfiles(inps, eor_id, eor_id_bulletin=None, session=None):
+    s = session
+    if not s:
+         s = session_login(inps.username, inps.password)
+
+    return get_entries_file_params(inps, get_eorid_entries(inps, eor_id, eor_id_bulletin, s), s)
 
 def get_eorid_bulletin(inps, eor_id, session=None):
     s = session
     if not s:
          s = session_login(inps.username, inps.password)
 
-    r_eorid = s.get(EOR_ID_BULLETIN.format(eor_id))
+    r_eorid = _request(s, 'GET', _url(EOR_ID_BULLETIN_PATH.format(eor_id)))
     print("EOR Bulletin status code:  {}".format(r_eorid.status_code))
     if r_eorid.status_code == 200:
         # print("EOR Bulletin response: {}".format(r_eorid.json()))
@@ -155,58 +232,108 @@ def get_file_params(inps, data_id, session=None):
     if not s:
          s = session_login(inps.username, inps.password)
 
-    dl_url = DL_URL + data_id
-    r_file_check = s.head(dl_url)
+    dl_url = _url(DL_PATH + data_id)
+    r_file_check = _request(s, 'HEAD', dl_url, allow_redirects=False)
     print("File check status code: {}".format(r_file_check.status_code))
     if r_file_check.status_code == 200:
         # print("File check headers: {}".format(r_file_check.headers))
         filename = r_file_check.headers['Content-Disposition'].split("=")[-1].strip().replace('"', '')
         filesize = int(r_file_check.headers['Content-Length'])
-        file_params = {"data_id":data_id, "download_url":dl_url,"filename":filename, "filesize":filesize}
+        etag = r_file_check.headers.get('ETag', '')
+        file_params = {"data_id":data_id, "download_url":dl_url,"filename":filename, "filesize":filesize, "etag":etag}
         return file_params
     else:
         raise RuntimeError("Unable to retrieve file parameters")
 
 
-def do_download(inps, download_params):
-    s = session_login(inps.username, inps.password)
-    # TODO: parallelize this!
-    for param in download_params:
-        dl_url = param['download_url']
-        r_download_check = s.head(dl_url)
-        print("Download check status code: {}".format(r_download_check.status_code))
-        if r_download_check.status_code == 200:
-            print("Download check headers: {}".format(r_download_check.headers))
-            r_download = s.get(dl_url, stream=True)
-            r_download.raise_for_status()
-            o_file = r_download_check.headers['Content-Disposition'].split("=")[-1].strip().replace('"', '')
-            # download file
-            if not os.path.isfile(o_file):
-                print("Downloading file to: {}".format(o_file))
-                with open(o_file, 'wb') as f:
+def _download_file(session, param):
+    """Download one file of download_params, resuming a partial file with a Range request.
+       A dropped or stalled connection is retried from the current file size, with backoff."""
+    dl_url = param['download_url']
+    o_file = param['filename']
+    filesize = param.get('filesize')
+    start = time.time()
+    initial = None
+    attempt = 0
+    while True:
+        existing = os.path.getsize(o_file) if os.path.isfile(o_file) else 0
+        if filesize and existing == filesize:
+            if initial is None:
+                print('Files exists, not downloading %s' % o_file)
+                return o_file
+            break
+        if filesize and existing > filesize:
+            print('%s is larger than expected (%s > %s B), downloading again' % (o_file, existing, filesize))
+            existing = 0
+
+        headers = {'Range': 'bytes=%s-' % existing} if existing else {}
+        try:
+            with _request(session, 'GET', dl_url, headers=headers, stream=True) as r_download:
+                r_download.raise_for_status()
+                if existing and r_download.status_code != 206:
+                    print("Server did not honour resume of %s, downloading from the start" % o_file)
+                    existing = 0
+                if initial is None:
+                    initial = existing
+                mode = 'ab' if existing else 'wb'
+
+                print("Downloading file to: {}{}".format(o_file, " (resuming at %s B)" % existing if existing else ""))
+                with open(o_file, mode) as f:
                     count = 0
-                    start = time.time()
-                    CHUNK = 256 * 1024
-                    for chunk in r_download.iter_content(chunk_size=CHUNK):
+                    for chunk in r_download.iter_content(chunk_size=DOWNLOAD_CHUNK):
                         count += 1
                         if chunk:  # filter out keep-alive new chunks
                             f.write(chunk)
                             if not count % 20:
-                                print("Wrote %s chunks: %s MB " % (count, str(count * CHUNK / (1024 * 1024))))
-                    f.close()
-                    total_time = time.time() - start
-                    mb_sec = (os.path.getsize(o_file) / (1024 * 1024.0)) / total_time
-                    print("Speed: %s MB/s" % mb_sec)
-                    print("Total Time: %s s" % total_time)
-            else:
-                print('Files exists, not downloading %s' % o_file)
+                                print("%s: wrote %s chunks: %s MB " % (o_file, count, str(count * DOWNLOAD_CHUNK / (1024 * 1024))))
+            if not filesize or os.path.getsize(o_file) == filesize:
+                break
+            error = "connection closed at %s of %s B" % (os.path.getsize(o_file), filesize)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.HTTPError) as e:
+            if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code < 500:
+                raise
+            error = str(e)
+        attempt += 1
+        if attempt > DOWNLOAD_RETRIES:
+            raise RuntimeError("Failed to download %s: %s" % (o_file, error))
+        wait = DOWNLOAD_BACKOFF * 2 ** (attempt - 1)
+        print("Download of %s interrupted (%s), retrying in %s s (%s/%s)" % (o_file, error, wait, attempt, DOWNLOAD_RETRIES))
+        time.sleep(wait)
+
+    total_time = time.time() - start
+    mb_sec = ((os.path.getsize(o_file) - (initial or 0)) / (1024 * 1024.0)) / total_time
+    print("%s speed: %s MB/s" % (o_file, mb_sec))
+    print("%s total Time: %s s" % (o_file, total_time))
+
+    if filesize and os.path.getsize(o_file) != filesize:
+        raise RuntimeError("Downloaded size of %s is %s B, expected %s B"
+                           % (o_file, os.path.getsize(o_file), filesize))
+    return o_file
+
+
+def do_download(inps, download_params):
+    """Download every file in download_params, DOWNLOAD_WORKERS at a time"""
+    # skip complete files before logging in or opening any connection
+    todo = [param for param in download_params
+            if not (os.path.isfile(param['filename']) and os.path.getsize(param['filename']) == param.get('filesize'))]
+    for param in download_params:
+        if param not in todo:
+            print('Files exists, not downloading %s' % param['filename'])
+    if not todo:
+        return
 
-            r_download.close()
+    s = session_login(inps.username, inps.password)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(todo))) as executor:
+        futures = [executor.submit(_download_file, s, param) for param in todo]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 if __name__ == '__main__':
     # Session will be closed at the end of with block
     inps = parse()
+    BASE_URL = inps.base_url
     # Download commanded
     if not (inps.eor_id or inps.data_id or inps.start_time):
         print("Please specify either eor_id or data_id or start_time")
@@ -7,7 +7,12 @@ Submits a standard job via a REST call
 from __future__ import print_function
 import json
 import argparse
-from hysds_commons.job_utils import submit_mozart_job
+import logging
+import concurrent.futures
+from datetime import datetime
+
+# simultaneous submissions in submit_jobs
+SUBMIT_WORKERS = 8
 
 def parse_job_tags(tag_string):
     if tag_string == None or tag_string == '' or (type(tag_string) is list and tag_string == []) :
@@ -16,6 +21,47 @@ def parse_job_tags(tag_string):
     tag_list = ['"{0}"'.format(tag) for tag in tag_list]
     return ','.join(tag_list)
 
+def mozart_backend(job_name, job_spec, params, rule):
+    """Submit one job to Mozart, returning its job id"""
+    from hysds_commons.job_utils import submit_mozart_job
+    return submit_mozart_job({}, rule,
+        hysdsio={"id": "internal-temporary-wiring",
+                 "params": params,
+                 "job-specification": job_spec},
+        job_name=job_name)
+
+def submit_jobs(job_spec, jobs, backend=mozart_backend, workers=SUBMIT_WORKERS):
+    """Submit a batch of (data_id, params, rule) jobs of job_spec concurrently, once per data_id.
+       backend(job_name, job_spec, params, rule) does the actual submission, mozart_backend by default.
+       Returns (submitted, failed): data_id -> job_name for the jobs submitted and
+       data_id -> error for the ones that were not."""
+    unique = {}
+    for data_id, params, rule in jobs:
+        if data_id in unique:
+            logging.info("Skipping duplicate job for %s" % data_id)
+            continue
+        unique[data_id] = (params, rule)
+
+    rtime = datetime.utcnow().strftime("%d_%b_%Y_%H:%M:%S")
+    submitted, failed = {}, {}
+    if not unique:
+        return submitted, failed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(unique))) as executor:
+        futures = {}
+        for data_id, (params, rule) in unique.items():
+            job_name = "%s-%s-%s" % (job_spec, data_id, rtime)
+            print("submitting job: %s" % job_name)
+            futures[executor.submit(backend, job_name, job_spec, params, rule)] = (data_id, job_name)
+        for future in concurrent.futures.as_completed(futures):
+            data_id, job_name = futures[future]
+            try:
+                logging.info("Submitted %s as %s" % (job_name, future.result()))
+                submitted[data_id] = job_name
+            except Exception as e:
+                logging.error("Failed to submit %s: %s" % (job_name, str(e)))
+                failed[data_id] = str(e)
+    return submitted, failed
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--job_name', help='Job name', dest='job_name', required=True)
@@ -35,10 +81,6 @@ if __name__ == "__main__":
     print(json.dumps(rule, sort_keys=True, indent=4, separators=(',', ': ')))
 
 
-    submit_mozart_job({}, rule,
-        hysdsio={"id": "internal-temporary-wiring",
-                 "params": params,
-                 "job-specification": args.job_spec},
-        job_name=args.job_name)
+    mozart_backend(args.job_name, args.job_spec, params, rule)
 
 